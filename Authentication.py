@@ -2,9 +2,11 @@
 ## 5/19/2016 - update to allow for authentication based on api-key, rather than username/pw
 ## See https://documentation.uts.nlm.nih.gov/rest/authentication.html for full explanation
 
+import os
+import time
+import threading
+import Queue
 import requests
-from pyquery import PyQuery as pq
-from lxml import etree
 
 uri="https://utslogin.nlm.nih.gov"
 
@@ -24,6 +26,8 @@ class Authentication:
      params = {'apikey': self.apikey}
      h = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain", "User-Agent":"python" }
      r = requests.post(uri+auth_endpoint,data=params,headers=h)
+     # Imported here, as it is only needed once per TGT
+     from pyquery import PyQuery as pq
      d = pq(r.text)
      ## extract the entire URL needed from the HTML form (action attribute) returned - looks similar to https://utslogin.nlm.nih.gov/cas/v1/tickets/TGT-36471-aYqNLN2rFIJPXKzxwdTNC5ZT7z3B3cTAKfSc5ndHQcUxeaDOLN-cas
      ## we make a POST call to this URL in the getst method
@@ -43,3 +47,143 @@ class Authentication:
 
 
 
+class TicketManager(object):
+    """
+    Manager of the tickets of the UMLS REST services. Keeps a TGT and
+    renews it before it expires (TGTs are valid for 8 hours), while a
+    background thread keeps a pool of service tickets fetched in advance.
+    Thread-safe, so a single manager can serve concurrent workers.
+    """
+
+    def __init__(self, apikey, pool_size=10, tgt_lifetime=7*3600, st_lifetime=4*60):
+        """
+        Initialization of the class. Nothing is requested until the first
+        ticket is asked for.
+        Input:
+            - apikey: str,
+            UMLS REST services api-key
+            - pool_size: int,
+            number of service tickets to keep ready
+            - tgt_lifetime: int,
+            seconds after which the TGT is renewed
+            - st_lifetime: int,
+            seconds after which a prefetched service ticket is considered
+            stale and thrown away (they are valid for 5 minutes)
+        """
+
+        self.client = Authentication(apikey)
+        self.pool_size = pool_size
+        self.tgt_lifetime = tgt_lifetime
+        self.st_lifetime = st_lifetime
+        self.tickets = Queue.Queue(maxsize=pool_size)
+        self.lock = threading.Lock()
+        self.tgt = None
+        self.tgt_time = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def get_tgt(self, renew=False):
+        """
+        Return the current TGT, getting a new one if there is none, it is
+        older than tgt_lifetime or renew is True.
+        """
+
+        with self.lock:
+            if renew or self.tgt is None or time.time() - self.tgt_time > self.tgt_lifetime:
+                self.tgt = self.client.gettgt()
+                self.tgt_time = time.time()
+            return self.tgt
+
+    def fetch_ticket(self):
+        """
+        Request a new service ticket. If the request fails, the TGT is
+        renewed and the request tried once more. Raises ValueError if that
+        doesn't give a ticket either.
+        """
+
+        try:
+            st = self.client.getst(self.get_tgt())
+            if st.startswith('ST-'):
+                return st
+        except requests.RequestException:
+            pass
+        # Probably an expired or revoked TGT
+        st = self.client.getst(self.get_tgt(renew=True))
+        if not st.startswith('ST-'):
+            raise ValueError('Could not get a service ticket: %s' % st[:200])
+        return st
+
+    def prefetch(self):
+        """
+        Body of the background thread. Keeps the pool of tickets full,
+        blocking while it is, and renews the TGT in time.
+        """
+
+        while not self.stop_event.is_set():
+            try:
+                st = self.fetch_ticket()
+                # Stamp the ticket now, not when it gets into the pool
+                fetched = time.time()
+            except Exception:
+                # Network hiccup, try again in a while
+                self.stop_event.wait(5)
+                continue
+            while not self.stop_event.is_set():
+                if time.time() - fetched >= self.st_lifetime:
+                    # Went stale while waiting for room in the pool
+                    break
+                try:
+                    self.tickets.put((fetched, st), timeout=1)
+                    break
+                except Queue.Full:
+                    # Renew the TGT proactively while idle
+                    self.get_tgt()
+
+    def start(self):
+        """
+        Start the prefetching thread, if it is not running in this process.
+        In a forked child, the pool of tickets and the synchronization
+        objects are created anew, so that the parent and the children never
+        hand out the same single-use ticket or wait on a lock held by a
+        thread that only exists in the parent.
+        """
+
+        if self.pid != os.getpid():
+            if self.pid is not None:
+                self.tickets = Queue.Queue(maxsize=self.pool_size)
+                self.lock = threading.Lock()
+                self.stop_event = threading.Event()
+                self.thread = None
+            self.pid = os.getpid()
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.prefetch)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def get_ticket(self):
+        """
+        Get a single use service ticket. Taken from the prefetched pool if
+        a fresh one is ready, otherwise fetched by the caller itself, so
+        that concurrent callers don't wait on the single prefetching thread.
+        Output:
+            - st: str,
+            the service ticket
+        """
+
+        self.start()
+        while True:
+            try:
+                fetched, st = self.tickets.get_nowait()
+            except Queue.Empty:
+                return self.fetch_ticket()
+            if time.time() - fetched < self.st_lifetime:
+                return st
+
+    def stop(self):
+        """
+        Stop the prefetching thread.
+        """
+
+        self.stop_event.set()
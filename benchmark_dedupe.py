@@ -0,0 +1,84 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+# Benchmark of the node deduplication of create_neo4j_harvester, comparing
+# the list scans it used to do with the whole function as it is now, on
+# synthetic mentions. The list scans alone take longer than the whole
+# function, so the speedup shown is a lower bound. No database, binary or
+# settings file is needed.
+# Usage: python benchmark_dedupe.py [mentions] [distinct cuis]
+
+import sys
+import time
+import random
+from config import settings
+from data_saver import create_neo4j_harvester
+
+
+def make_documents(n_mentions, n_cuis, per_sent=5, per_doc=50):
+    """
+    Generate documents with n_mentions entities drawn from n_cuis concepts,
+    in the form of the semrep extractor output.
+    """
+    rnd = random.Random(0)
+    docs = []
+    c = 0
+    while c < n_mentions:
+        sents = []
+        for sent_id in xrange(per_doc / per_sent):
+            ents = []
+            for i in xrange(min(per_sent, n_mentions - c)):
+                # Separate string objects, as read from the extractor output
+                cuid = ''.join(['C', '%07d' % rnd.randint(0, n_cuis - 1)])
+                ents.append({'cuid': cuid, 'label': cuid, 'sem_types': 'aapp', 'score': '1000'})
+                c += 1
+            sents.append({'sent_id': sent_id, 'sent_text': 'sentence', 'entities': ents, 'relations': []})
+        docs.append({'id': 'doc%d' % len(docs), 'title': 'title', 'journal': 'journal',
+                     'text': 'text', 'sents': sents})
+    return docs
+
+
+def dedupe_list(docs):
+    """
+    Unique entity nodes with the list scans create_neo4j_harvester used to
+    do for every mention.
+    """
+    unique_cuis = []
+    nodes = []
+    for doc in docs:
+        for sent in doc['sents']:
+            for ent in sent['entities']:
+                if not(ent['cuid'] in unique_cuis):
+                    unique_cuis.append(ent['cuid'])
+                    nodes.append({'id:ID': ent['cuid'], 'label': ent['label']})
+    return nodes
+
+
+def harvester_nodes(docs):
+    """
+    Unique entity nodes of create_neo4j_harvester, as it is now.
+    """
+    results = create_neo4j_harvester({'documents': docs})
+    return [group for group in results['nodes'] if group['type'] == 'Entity'][0]['values']
+
+
+def timed(name, func, *args):
+    start = time.time()
+    res = func(*args)
+    elapsed = time.time() - start
+    print '%-30s %10.2f s' % (name, elapsed)
+    return res, elapsed
+
+
+if __name__ == '__main__':
+    n_mentions = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+    n_cuis = int(float(sys.argv[2])) if len(sys.argv) > 2 else 2000
+    settings._settings = {'out': {'json': {'json_doc_field': 'documents', 'json_text_field': 'text',
+                                           'json_id_field': 'id', 'json_label_field': 'title',
+                                           'sent_prefix': 'abstract'}}}
+    docs = make_documents(n_mentions, n_cuis)
+    print 'Deduplicating %d mentions of %d distinct cuis' % (n_mentions, n_cuis)
+    old, t_old = timed('list scan', dedupe_list, docs)
+    new, t_new = timed('create_neo4j_harvester', harvester_nodes, docs)
+    assert [node['id:ID'] for node in old] == [node['id:ID'] for node in new]
+    print 'Speedup: at least %0.1fx' % (t_old / max(t_new, 1e-9))
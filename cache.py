@@ -0,0 +1,340 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# On-disk key-value store used for caching results between runs. Backed
+# by SQLite in WAL mode, so that several pipeline processes can read and
+# write the same cache file at the same time.
+
+import os
+import sys
+import json
+import time
+import sqlite3
+from utilities import time_log
+
+
+class KeyValueStore(object):
+    """
+    Persistent key-value store on top of an SQLite table. Values are saved
+    as json strings. Lookups go straight to the index of the table, while
+    new values are kept in memory and written in batches of batch_size.
+    """
+
+    def __init__(self, path, table='cache', batch_size=500):
+        """
+        Initialization of the class. The database and the table are created
+        if they don't exist.
+        Input:
+            - path: str,
+            path to the SQLite file
+            - table: str,
+            name of the table to keep the values in
+            - batch_size: int,
+            number of pending values that triggers a write
+        """
+
+        self.path = path
+        self.table = table
+        self.batch_size = batch_size
+        self.pending = {}
+        self.conn = None
+        self.pid = None
+        self.connect()
+
+    def connect(self):
+        """
+        Open the connection of the current process. SQLite connections
+        can't be shared across a fork, so a new one is opened if the store
+        is used from a child process.
+        """
+
+        if self.conn is not None and self.pid == os.getpid():
+            return self.conn
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.create_table(self.conn)
+        self.conn.commit()
+        self.pid = os.getpid()
+        return self.conn
+
+    def create_table(self, conn):
+        """
+        Create the table of the store if it doesn't exist.
+        """
+
+        conn.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT)' % self.table)
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for key or default if it is missing.
+        """
+
+        if key in self.pending:
+            return self.pending[key]
+        row = self.connect().execute('SELECT value FROM %s WHERE key = ?' % self.table,
+                                     (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def get_many(self, keys):
+        """
+        Return a dictionary with the values of the keys that are found in
+        the store. Missing keys are left out.
+        """
+
+        found = {}
+        rest = []
+        for key in set(keys):
+            if key in self.pending:
+                found[key] = self.pending[key]
+            else:
+                rest.append(key)
+        conn = self.connect()
+        # Keep well below the SQLite limit of variables in a statement
+        for i in xrange(0, len(rest), 500):
+            batch = rest[i:i+500]
+            quer = 'SELECT key, value FROM %s WHERE key IN (%s)' % (self.table, ','.join(['?']*len(batch)))
+            for key, value in conn.execute(quer, batch):
+                found[key] = json.loads(value)
+        return found
+
+    def __contains__(self, key):
+        if key in self.pending:
+            return True
+        row = self.connect().execute('SELECT 1 FROM %s WHERE key = ?' % self.table,
+                                     (key,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value):
+        """
+        Store a value for key. The value is written to disk with the next
+        batch.
+        """
+
+        self.pending[key] = value
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def put_many(self, items):
+        """
+        Store many (key, value) pairs at once.
+        """
+
+        for key, value in items:
+            self.pending[key] = value
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all the pending values to disk in a single transaction.
+        """
+
+        if not self.pending:
+            return
+        conn = self.connect()
+        rows = [(key, json.dumps(value)) for key, value in self.pending.iteritems()]
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)' % self.table, rows)
+        self.pending = {}
+
+    def __len__(self):
+        self.flush()
+        return self.connect().execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def close(self):
+        """
+        Flush pending values and close the connection.
+        """
+
+        self.flush()
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+    def import_json(self, json_path):
+        """
+        One-shot import of an existing json cache file, as the cache.json
+        files written by previous versions of get_concepts_from_edges.
+        Input:
+            - json_path: str,
+            path to the json file containing a single dictionary
+        Output:
+            - the number of imported keys
+        """
+
+        with open(json_path, 'r') as f:
+            old = json.load(f)
+        self.put_many(old.iteritems())
+        self.flush()
+        time_log('Imported %d keys from %s to %s' % (len(old), json_path, self.path))
+        return len(old)
+
+
+class LRUStore(KeyValueStore):
+    """
+    KeyValueStore bounded in size. The size of each value and the last
+    time it was read or written are kept along with it, and when the
+    values exceed max_size bytes the least recently used ones are evicted.
+    Reads are marked in memory and written with the next batch. The total
+    size is summed once when the store is opened in a process and then
+    kept up to date with each batch, so that the table is only scanned
+    when it is over max_size.
+    """
+
+    def __init__(self, path, table='cache', batch_size=500, max_size=1 << 30):
+        """
+        Initialization of the class.
+        Input:
+            - path, table, batch_size:
+            check KeyValueStore
+            - max_size: int,
+            maximum total size of the values in bytes
+        """
+
+        self.max_size = max_size
+        self.touched = set()
+        self.total = 0
+        super(LRUStore, self).__init__(path, table, batch_size)
+
+    def connect(self):
+        """
+        Open the connection of the current process, check KeyValueStore,
+        and load the total size of the values when it is a new one.
+        """
+
+        is_new = self.conn is None or self.pid != os.getpid()
+        conn = super(LRUStore, self).connect()
+        if is_new:
+            self.total = self.table_size(conn)
+        return conn
+
+    def table_size(self, conn):
+        """
+        Return the total size of the values in the table.
+        """
+
+        return conn.execute('SELECT COALESCE(SUM(size), 0) FROM %s' % self.table).fetchone()[0]
+
+    def create_table(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT, '
+                     'size INTEGER, atime REAL)' % self.table)
+        conn.execute('CREATE INDEX IF NOT EXISTS %s_atime ON %s (atime)' % (self.table, self.table))
+
+    def get(self, key, default=None):
+        value = super(LRUStore, self).get(key, default)
+        if not(key in self.pending) and value is not default:
+            self.touched.add(key)
+            if len(self.touched) >= self.batch_size:
+                self.flush()
+        return value
+
+    def get_many(self, keys):
+        found = super(LRUStore, self).get_many(keys)
+        self.touched.update(key for key in found if not(key in self.pending))
+        if len(self.touched) >= self.batch_size:
+            self.flush()
+        return found
+
+    def flush(self):
+        """
+        Write the pending values and the access times of the values read,
+        then evict the least recently used values if the store is over
+        max_size.
+        """
+
+        if not(self.pending) and not(self.touched):
+            return
+        conn = self.connect()
+        now = time.time()
+        rows = []
+        for key, value in self.pending.iteritems():
+            value = json.dumps(value)
+            rows.append((key, value, len(value), now))
+        # Replaced values no longer count towards the total
+        keys = self.pending.keys()
+        for i in xrange(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            query = 'SELECT SUM(size) FROM %s WHERE key IN (%s)' % (self.table, ','.join('?' * len(chunk)))
+            self.total -= conn.execute(query, chunk).fetchone()[0] or 0
+        self.total += sum(row[2] for row in rows)
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO %s (key, value, size, atime) VALUES (?, ?, ?, ?)'
+                             % self.table, rows)
+            conn.executemany('UPDATE %s SET atime = ? WHERE key = ?' % self.table,
+                             [(now, key) for key in self.touched])
+        self.pending = {}
+        self.touched = set()
+        if self.total > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used values until the store fits in
+        max_size bytes. The total is summed again first, since other
+        processes may have written to or evicted from the same table.
+        """
+
+        conn = self.connect()
+        self.total = self.table_size(conn)
+        if self.total <= self.max_size:
+            return
+        excess = self.total - self.max_size
+        keys = []
+        for key, size in conn.execute('SELECT key, size FROM %s ORDER BY atime' % self.table):
+            keys.append((key,))
+            excess -= size
+            self.total -= size
+            if excess <= 0:
+                break
+        with conn:
+            conn.executemany('DELETE FROM %s WHERE key = ?' % self.table, keys)
+        time_log('Evicted %d values from %s' % (len(keys), self.path))
+
+
+def open_cache(path, batch_size=500):
+    """
+    Open the concept cache found in path. If path still points to a json
+    cache file from a previous version, the store is created next to it
+    with a .db extension and the json file is imported into it once.
+    Input:
+        - path: str,
+        path to the cache, as given by cache_path in settings.yaml
+        - batch_size: int,
+        number of pending values that triggers a write
+    Output:
+        - store: KeyValueStore,
+        the opened store
+    """
+
+    if path.endswith('.json'):
+        db_path = os.path.splitext(path)[0] + '.db'
+        is_new = not(os.path.isfile(db_path))
+        store = KeyValueStore(db_path, batch_size=batch_size)
+        if is_new and os.path.isfile(path):
+            store.import_json(path)
+    else:
+        store = KeyValueStore(path, batch_size=batch_size)
+    return store
+
+
+if __name__ == '__main__':
+    # Usage: python cache.py cache.json cache.db
+    if len(sys.argv) != 3:
+        print 'Usage: python cache.py <cache.json> <cache.db>'
+        exit(1)
+    store = KeyValueStore(sys.argv[2])
+    store.import_json(sys.argv[1])
+    store.close()
@@ -0,0 +1,144 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Checkpoints of long pipeline runs, so that a crashed run can continue
+# from the last finished step instead of starting over. Everything is kept
+# as gzipped binary pickles, which are a lot smaller and faster to write
+# than the pretty-printed json output.
+
+import os
+import gzip
+import cPickle as pickle
+from utilities import time_log
+
+
+class Checkpoint(object):
+    """
+    Progress of a taskCoordinator run, kept in a directory with two files:
+        - state.pkl.gz: the state after the last finished step of the
+        pipeline, replaced atomically after every step
+        - chunks.pkl.gz: the results of the step in progress, appended
+        every few documents as separate gzip members, so that a crash
+        loses at most the chunk being processed
+    """
+
+    def __init__(self, path, every=1000):
+        """
+        Initialization of the class. The directory is created if needed.
+        Input:
+            - path: str,
+            directory to keep the checkpoint files in
+            - every: int,
+            number of documents processed between two chunk checkpoints
+        """
+
+        self.path = path
+        self.every = max(int(every), 1)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.state_path = os.path.join(path, 'state.pkl.gz')
+        self.chunks_path = os.path.join(path, 'chunks.pkl.gz')
+
+    def write(self, path, objects):
+        """
+        Atomically replace path with a gzipped pickle of the objects.
+        """
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            gz = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1)
+            for obj in objects:
+                pickle.dump(obj, gz, pickle.HIGHEST_PROTOCOL)
+            gz.close()
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def read(self, path):
+        """
+        Return the list of objects pickled in path. A truncated object at
+        the end, left by a crash in the middle of a write, is dropped.
+        """
+
+        objects = []
+        if not os.path.isfile(path):
+            return objects
+        with gzip.open(path, 'rb') as gz:
+            while True:
+                try:
+                    objects.append(pickle.load(gz))
+                except EOFError:
+                    break
+                except (IOError, pickle.UnpicklingError, ValueError):
+                    time_log('Dropping truncated checkpoint data in %s' % path)
+                    break
+        return objects
+
+    def save_state(self, state):
+        """
+        Save the state after a finished step and drop the chunks of it.
+        Input:
+            - state: dic,
+            dictionary with the fields done (number of finished steps) and
+            json_ (the results so far)
+        """
+
+        self.write(self.state_path, [state])
+        if os.path.isfile(self.chunks_path):
+            os.remove(self.chunks_path)
+        time_log('Checkpoint saved after step %d in %s' % (state['done'], self.path))
+
+    def add_chunk(self, position, docs):
+        """
+        Append the results of a chunk of the step in progress.
+        Input:
+            - position: int,
+            number of input documents of the step processed so far
+            - docs: list,
+            the resulting documents of the chunk
+        """
+
+        with open(self.chunks_path, 'ab') as f:
+            gz = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1)
+            pickle.dump((position, docs), gz, pickle.HIGHEST_PROTOCOL)
+            gz.close()
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self):
+        """
+        Load the last saved progress.
+        Output:
+            - state: dic,
+            the last saved state, or None if there is no checkpoint
+            - position: int,
+            number of input documents of the next step already processed
+            - docs: list,
+            the resulting documents of these
+        """
+
+        states = self.read(self.state_path)
+        if not states:
+            return None, 0, []
+        chunks = self.read(self.chunks_path)
+        position = 0
+        docs = []
+        for position, chunk_docs in chunks:
+            docs.extend(chunk_docs)
+        # Rewrite the chunks without any truncated data at the end, so that
+        # new chunks can be appended to it
+        if chunks:
+            self.write(self.chunks_path, chunks)
+        elif os.path.isfile(self.chunks_path):
+            os.remove(self.chunks_path)
+        return states[0], position, docs
+
+    def clear(self):
+        """
+        Remove the checkpoint files after a successful run.
+        """
+
+        for path in [self.state_path, self.chunks_path]:
+            if os.path.isfile(path):
+                os.remove(path)
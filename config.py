@@ -2,20 +2,55 @@
 
 """
 Simple module wrapper to load settings file in order
-to have it available in all modules.
+to have it available in all modules. The settings file
+is read on first access, so importing the modules of the
+project is cheap and works offline.
 """
 import yaml
 import os
-from Authentication import Authentication
+
 
 settings_filename = os.path.join(os.path.dirname(__file__), 'settings.yaml')
-with open(settings_filename, "r") as f:
-    settings = yaml.load(f)
 
-# API-kEY FOR UMLS REST TICKET SERVICES
-umls_api = settings['apis']['umls']
-# UMLS REST SERVICES INITIALIZATION OF CLIENT AND TICKET
-# GRANTING SERVICE TO BE USED IN ALL CASES
-AuthClient = Authentication(umls_api)
-tgt = AuthClient.gettgt()
 
+class LazySettings(object):
+    """
+    Read-only dictionary-like wrapper around the settings file, that
+    parses it on first access.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._settings = None
+
+    def load(self):
+        """
+        Parse the settings file, if not already parsed, and return the
+        resulting dictionary.
+        """
+
+        if self._settings is None:
+            with open(self.filename, "r") as f:
+                self._settings = yaml.load(f)
+        return self._settings
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def keys(self):
+        return self.load().keys()
+
+    def iteritems(self):
+        return self.load().iteritems()
+
+
+settings = LazySettings(settings_filename)
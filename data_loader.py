@@ -8,20 +8,19 @@
 
 import json
 import os
-import py2neo
+import copy
 import csv
 import subprocess
+import multiprocessing
 import urllib2
 import requests
 import sys
-import unicodecsv as csv2
-import pandas as pd
-import numpy as np
-from nltk.tokenize import sent_tokenize
+import hashlib
 from config import settings
-from pymetamap import MetaMap
-from utilities import time_log, get_concept_from_cui, get_concept_from_source
-from itertools import product
+from utilities import time_log, get_concept_from_cui, get_concept_from_source, get_umls_client
+from nlp_engines import get_semrep_pool, get_metamap_engine, get_reverb_engine
+from cache import open_cache, KeyValueStore, LRUStore
+from itertools import product, izip
 
 
 def metamap_wrapper(text):
@@ -40,29 +39,15 @@ def metamap_wrapper(text):
        a list of the concepts found
     """
 
-    # Tokenize into sentences
-    sents = sent_tokenize(text)
-    # Load Metamap Instance
-    mm = MetaMap.get_instance(settings['load']['path']['metamap'])
-    concepts, errors = mm.extract_concepts(sents, range(len(sents)))
-    # Keep the sentence ids
-    ids = np.array([int(concept[0]) for concept in concepts])
-    sentences = []
-    for i in xrange(len(sents)):
-        tmp = {'sent_id': i+1, 'entities': [], 'relations': []}
-        # Wanted concepts according to sentence
-        wanted = np.where(ids == i)[0].tolist()
-        for w_ind in wanted:
-            w_conc = concepts[w_ind]
-            if hasattr(w_conc, 'cui'):
-                tmp_conc = {'label': w_conc.preferred_name, 'cui': w_conc.cui, 
-                            'sem_types': w_conc.semtypes, 'score': w_conc.score}
-                tmp['entities'].append(tmp_conc)
-        sentences.append(tmp)
-    if errors:
-        time_log('Errors with extracting concepts!')
-        time_log(errors)
-    return {'sents': sentences, 'sent_text':text}
+    return cached_result('metamap', text, run_metamap)
+
+
+def run_metamap(text):
+    """
+    Run MetaMap on text, without the result cache. Check metamap_wrapper.
+    """
+    return get_metamap_engine(settings['load']['path']['metamap'],
+                              settings['load']['metamap']['batch_size']).extract_texts([text])[0]
 
 
 def runProcess(exe, working_dir):    
@@ -140,40 +125,6 @@ def create_text_batches(text, N=5000, buffer_ = 100):
     return chunks
 
 
-
-def reverb_wrapper(text, stop=None):
-    """
-    Function-wrapper for ReVerb binary. Extracts relations
-    found in text.
-    Input:
-        - text: str,
-        a piece of text or sentence
-        - stop: list,
-        list of stopwords to remove from the relations
-    Output:
-        - total: list,
-        list of lists. Each inner list contains one relation in the form
-        [subject, predicate, object]
-    """
-    total = []
-    for sent in sent_tokenize(text):
-        cmd = 'echo "' + sent + '"' "| ./reverb -q | tr '\t' '\n' | cat -n"
-        reverb_dir = settings['load']['path']['reverb']
-        result = runProcess(cmd, reverb_dir)
-        # Extract relations from reverb output
-        result = result[-3:]
-        result = [row.split('\t')[1].strip('\n') for row in result]
-        # Remove common stopwords from relations
-        if stop:
-            result = [stopw_removal(res, stop) for res in result]
-        total.append(result)
-    # Remove empty relations
-    total = [t for t in total if t]
-    return total
-
-
-
-
 def cui_to_uri(api_key, cui):
     """
     Function to map from cui to uri if possible. Uses biontology portal
@@ -318,6 +269,7 @@ def extract_entities(text, json_={}):
         json with fields text, sents, concepts and entities
         containg the final results
     """
+    from nltk.tokenize import sent_tokenize
     json_['text'] = text
     # Tokenize the text
     sents = sent_tokenize(text)
@@ -329,7 +281,60 @@ def extract_entities(text, json_={}):
         json_['entities'][sent['sent_id']] = ents
     return json_
 
-def extract_metamap(json_, key):
+
+def metamap_documents(texts, pool=None):
+    """
+    Extract concepts from the cleaned texts of many documents using the
+    MetaMap binary. The sentences of the documents not found in the result
+    cache are submitted together in groups of up to batch_size sentences,
+    spread across the processes given by the workers field of
+    pipeline.trans, check batch_documents and MetaMapEngine.
+    Input:
+        - texts: iterable,
+        the cleaned texts of the documents
+        - pool: multiprocessing.Pool,
+        pool of worker processes to use, e.g. from open_worker_pool.
+        Defaults to a pool for this call only
+    Output:
+        - generator of the results of each document, as returned by
+        metamap_wrapper
+    """
+    return batch_documents('metamap', metamap_batch, texts,
+                           settings['load']['metamap']['batch_size'], pool)
+
+
+def metamap_batch(docs):
+    """
+    Worker function of metamap_documents, extracting a group of documents
+    with the MetaMapEngine of the current process.
+    Input:
+        - docs: list,
+        list of (text, sentences) tuples
+    Output:
+        - results: list,
+        the results of each text
+    """
+    engine = get_metamap_engine(settings['load']['path']['metamap'],
+                                settings['load']['metamap']['batch_size'])
+    return engine.extract_tokenized(docs)
+
+
+def metamap_document(text):
+    """
+    Extract concepts from the cleaned text of a single document using the
+    MetaMap binary. Sentences are submitted one by one, so long texts
+    don't need to be split.
+    Input:
+        - text: str,
+        the cleaned text of the document
+    Output:
+        - results: dic,
+        json-style dictionary with fields sent_text and sents
+    """
+    return metamap_wrapper(text)
+
+
+def extract_metamap(json_, key, pool=None):
     """
     Task function to parse and extract concepts from json_ style dic, using
     the MetaMap binary.
@@ -340,34 +345,150 @@ def extract_metamap(json_, key):
         - key : str,
         string denoting the type of medical text to read from. Used to
         find the correct paragraph in the settings.yaml file.
+        - pool: multiprocessing.Pool,
+        pool of worker processes shared by the whole run, or None
     Output:
         - json_ : dic,
         the previous json-style dictionary enriched with medical concepts
     """
-    # outerfield for the documents in json
-    docfield = settings['out'][key]['json_doc_field']
-    # textfield to read text from
-    textfield = settings['out'][key]['json_text_field']
-    N = len(json_[docfield])
-    for i, doc in enumerate(json_[docfield]):
-        text = clean_text(doc[textfield])
-        if len(text) > 5000:
-            chunks = create_text_batches(text)
-            results = {'text': text, 'sents': []}
-            sent_id = 0
-            for chunk in chunks:
-                tmp = metamap_wrapper(chunk)
-                for sent in tmp['sents']:
-                    sent['sent_id'] = sent_id
-                    sent_id += 1
-                    results['sents'].append(sent)
-        else:
-            results = metamap_wrapper(text)
-        json_[docfield][i].update(results)
-        proc = int(i/float(N)*100)
-        if proc % 10 == 0 and proc > 0:
-            time_log('We are at %d/%d documents -- %0.2f %%' % (i, N, proc))
-    return json_
+    return extract_documents(json_, key, metamap_document, metamap_documents, pool)
+
+
+# ReVerb binary and the flags it is called with, run from the reverb path
+REVERB_BIN = './reverb'
+REVERB_FLAGS = ['-q']
+
+
+def get_reverb():
+    """
+    Get the ReVerbEngine of this process, as configured in settings.yaml.
+    """
+    return get_reverb_engine(settings['load']['path']['reverb'], [REVERB_BIN] + REVERB_FLAGS,
+                             settings['load']['reverb']['batch_size'])
+
+
+def reverb_relation(extraction):
+    """
+    Turn a ReVerb extraction into a relation with the fields of the SemRep
+    relations. ReVerb gives only the text of the arguments, so the cuis
+    and semantic types are left empty and the confidence is used as the
+    score of both arguments.
+    """
+    rel = dict((key, '') for key in SEMREP_MAPPINGS['relation'])
+    rel.update({'subject__label': extraction['arg1'],
+                'predicate': extraction['rel'],
+                'predicate__type': 'reverb',
+                'object__label': extraction['arg2'],
+                'subject__score': extraction['confidence'],
+                'object__score': extraction['confidence']})
+    return rel
+
+
+def reverb_results(docs, grouped):
+    """
+    Build the results of each document from the ReVerb extractions of its
+    sentences.
+    Input:
+        - docs: list,
+        list of (text, sentences) tuples
+        - grouped: list,
+        the extractions of each sentence of all the docs, in order
+    Output:
+        - results: list,
+        json-style dictionaries with fields text and sents, as in semrep
+    """
+    results = []
+    c = 0
+    for text, sents in docs:
+        sentences = []
+        for i, sent in enumerate(sents):
+            sentences.append({'sent_id': i, 'sent_text': sent, 'entities': [],
+                              'relations': [reverb_relation(ext) for ext in grouped[c]]})
+            c += 1
+        results.append({'text': text, 'sents': sentences})
+    return results
+
+
+def reverb_wrapper(text):
+    """
+    Function-wrapper for ReVerb binary. Extracts relations found in text,
+    through the result cache.
+    Input:
+        - text: str,
+        a piece of text
+    Output:
+        - results: dic,
+        json-style dictionary with fields text and sents. Each sentence has
+        the relations found in it, check reverb_relation
+    """
+    return cached_result('reverb', text, run_reverb)
+
+
+def run_reverb(text):
+    """
+    Run ReVerb on text, without the result cache. Check reverb_wrapper.
+    """
+    from nltk.tokenize import sent_tokenize
+    sents = sent_tokenize(text)
+    return reverb_results([(text, sents)], get_reverb().extract_sentences(sents))[0]
+
+
+def reverb_document(text):
+    """
+    Extract relations from the cleaned text of a single document using the
+    ReVerb binary.
+    """
+    return reverb_wrapper(text)
+
+
+def reverb_documents(texts, pool=None):
+    """
+    Extract relations from the cleaned texts of many documents using the
+    ReVerb binary. The sentences of the documents not found in the result
+    cache are streamed through a single JVM per group of up to batch_size
+    sentences, spread across the processes given by the workers field of
+    pipeline.trans, check batch_documents and ReVerbEngine.
+    Input:
+        - texts: iterable,
+        the cleaned texts of the documents
+        - pool: multiprocessing.Pool,
+        pool of worker processes to use, e.g. from open_worker_pool.
+        Defaults to a pool for this call only
+    Output:
+        - generator of the results of each document, as returned by
+        reverb_wrapper
+    """
+    return batch_documents('reverb', reverb_batch, texts,
+                           settings['load']['reverb']['batch_size'], pool)
+
+
+def reverb_batch(docs):
+    """
+    Worker function of reverb_documents, extracting a group of documents
+    with the ReVerbEngine of the current process. Check metamap_batch.
+    """
+    grouped = get_reverb().extract_sentences([sent for text, sents in docs for sent in sents])
+    return reverb_results(docs, grouped)
+
+
+def extract_reverb(json_, key, pool=None):
+    """
+    Task function to parse and extract relations from json_ style dic,
+    using the ReVerb binary.
+    Input:
+        - json_ : dic,
+        json-style dictionary generated from the Parse object related
+        to the specific type of input
+        - key : str,
+        string denoting the type of medical text to read from. Used to
+        find the correct paragraph in the settings.yaml file.
+        - pool: multiprocessing.Pool,
+        pool of worker processes shared by the whole run, or None
+    Output:
+        - json_ : dic,
+        the previous json-style dictionary enriched with relations
+    """
+    return extract_documents(json_, key, reverb_document, reverb_documents, pool)
 
 
 def enrich_with_triples(results, subject, pred='MENTIONED_IN'):
@@ -396,57 +517,56 @@ def enrich_with_triples(results, subject, pred='MENTIONED_IN'):
         
 
 
-def semrep_wrapper(text):
+# SemRep binary and the flags it is called with. Only -F output is
+# supported by parse_semrep_lines.
+SEMREP_BIN = './semrep.v1.7'
+SEMREP_FLAGS = ['-L', '2015', '-Z', '2015AA', '-F']
+
+# mapping of -F output line elements to fields
+SEMREP_MAPPINGS = {
+    "text": {
+        "sent_id": 4,
+        "sent_text": 6
+    },
+    "entity": {
+        'cuid': 6,
+        'label': 7,
+        'sem_types': 8,
+        'score': 15
+    },
+    "relation": {
+        'subject__cui': 8,
+        'subject__label': 9,
+        'subject__sem_types': 10,
+        'subject__sem_type': 11,
+        'subject__score': 18,
+        'predicate__type': 21,
+        'predicate': 22,
+        'negation': 23,
+        'object__cui': 28,
+        'object__label': 29,
+        'object__sem_types': 30,
+        'object__sem_type': 31,
+        'object__score': 38,
+    }
+}
+
+
+def parse_semrep_lines(lines):
     """
-    Function wrapper for SemRep binary. It is called with flags
-    -F only and changing this will cause this parsing to fail, cause
-    the resulting lines won't have the same structure.
+    Parse the output lines of SemRep, called with the -F flag. Lines are
+    consumed one at a time, so a generator reading straight from the
+    process can be given.
     Input:
-        - text: str,
-        a piece of text or sentence
+        - lines: iterable,
+        the output lines of the binary
     Output:
-        - results: dic,
-        jston-style dictionary with fields text and sents. Each
-        sentence has entities and relations found in it. Each entity and
-        each relation has attributes denoted in the corresponding
-        mappings dictionary. 
+        - sents: list,
+        list of sentences. Each sentence has entities and relations found
+        in it, with attributes denoted in SEMREP_MAPPINGS.
     """
-    # Exec the binary
-    # ???This is a temporary fix for the encoding problems???
-    text = repr(text)
-    #text = text
-    cmd = "echo " + text + " | ./semrep.v1.7 -L 2015 -Z 2015AA -F"
-    semrep_dir = settings['load']['path']['semrep']
-    lines = runProcess(cmd, semrep_dir)
-    # mapping of line elements to fields
-    mappings = {
-        "text": {
-            "sent_id": 4,
-            "sent_text": 6
-        },
-        "entity": {
-            'cuid': 6,
-            'label': 7,
-            'sem_types': 8,
-            'score': 15
-        },
-        "relation": {
-            'subject__cui': 8,
-            'subject__label': 9,
-            'subject__sem_types': 10,
-            'subject__sem_type': 11,
-            'subject__score': 18,
-            'predicate__type': 21,
-            'predicate': 22,
-            'negation': 23,
-            'object__cui': 28,
-            'object__label': 29,
-            'object__sem_types': 30,
-            'object__sem_type': 31,
-            'object__score': 38,
-        }
-    }
-    results = {'sents': [], 'text': text}
+    mappings = SEMREP_MAPPINGS
+    sents = []
     for line in lines:
         # If Sentence
         if line.startswith('SE'):
@@ -460,7 +580,7 @@ def semrep_wrapper(text):
                 tmp = {"entities": [], "relations": []}
                 for key, ind in mappings['text'].iteritems():
                     tmp[key] = elements[ind]
-                results['sents'].append(tmp)
+                sents.append(tmp)
             # A line containing entity info
             if elements[5] == 'entity':
                 tmp = {}
@@ -468,7 +588,7 @@ def semrep_wrapper(text):
                     if key == 'sem_types':
                         tmp[key] = elements[ind].split(',')
                     tmp[key] = elements[ind]
-                results['sents'][-1]['entities'].append(tmp)
+                sents[-1]['entities'].append(tmp)
             # A line containing relation info
             if elements[5] == 'relation':
                 tmp = {}
@@ -477,7 +597,48 @@ def semrep_wrapper(text):
                         tmp[key] = elements[ind].split(',')
                     else:
                         tmp[key] = elements[ind]
-                results['sents'][-1]['relations'].append(tmp)
+                sents[-1]['relations'].append(tmp)
+    return sents
+
+
+def semrep_wrapper(text):
+    """
+    Function wrapper for SemRep binary. It is called with flags
+    -F only and changing this will cause this parsing to fail, cause
+    the resulting lines won't have the same structure. If pool_size
+    in the load.semrep settings is positive, the text is fed to a pool of
+    long-lived SemRep processes, instead of a new shell for each call.
+    Results are kept in the result cache, check cached_result.
+    Input:
+        - text: str,
+        a piece of text or sentence
+    Output:
+        - results: dic,
+        jston-style dictionary with fields text and sents. Each
+        sentence has entities and relations found in it. Each entity and
+        each relation has attributes denoted in the corresponding
+        mappings dictionary. 
+    """
+    return cached_result('semrep', text, run_semrep)
+
+
+def run_semrep(text):
+    """
+    Run SemRep on text, without the result cache. Check semrep_wrapper.
+    """
+    semrep_dir = settings['load']['path']['semrep']
+    pool_size = settings['load']['semrep']['pool_size']
+    if pool_size:
+        pool = get_semrep_pool(semrep_dir, [SEMREP_BIN] + SEMREP_FLAGS, pool_size)
+        sents = parse_semrep_lines(pool.lines(text))
+        return {'sents': sents, 'text': text}
+    # Exec the binary
+    # ???This is a temporary fix for the encoding problems???
+    text = repr(text)
+    #text = text
+    cmd = "echo " + text + " | " + ' '.join([SEMREP_BIN] + SEMREP_FLAGS)
+    lines = runProcess(cmd, semrep_dir)
+    results = {'sents': parse_semrep_lines(lines), 'text': text}
     return results
 
 
@@ -499,10 +660,583 @@ def clean_text(text):
     return text
 
 
-def extract_semrep(json_, key):
+def extract_in_batches(text, wrapper, N=5000):
     """
-    Task function to parse and extract concepts from json_ style dic, using
-    the SemRep binary.
+    Run an extractor wrapper on the text of a document. If the text is
+    longer than N characters, it is split with create_text_batches. Either
+    way, the sentences are numbered consecutively from 0 with
+    renumber_sents, so that their ids don't depend on how the text was
+    split, packed or deduplicated.
+    Input:
+        - text: str,
+        the cleaned text of the document
+        - wrapper: function,
+        one of the *_wrapper functions, returning a dictionary with a
+        sents field
+        - N: int,
+        length over which the text is split
+    Output:
+        - results: dic,
+        json-style dictionary with fields text and sents
+    """
+    if len(text) > N:
+        chunks = create_text_batches(text, N)
+        results = {'text': text, 'sents': []}
+        sent_id = 0
+        for chunk in chunks:
+            tmp = wrapper(chunk)
+            for sent in tmp['sents']:
+                sent['sent_id'] = sent_id
+                sent_id += 1
+                results['sents'].append(sent)
+    else:
+        results = renumber_sents(wrapper(text))
+    return results
+
+
+def semrep_document(text):
+    """
+    Extract concepts and relations from the cleaned text of a single
+    document using the SemRep binary.
+    Input:
+        - text: str,
+        the cleaned text of the document
+    Output:
+        - results: dic,
+        json-style dictionary with fields text and sents
+    """
+    return extract_in_batches(text, semrep_wrapper)
+
+
+# Sentence put between the documents packed in a single SemRep input
+SEMREP_DOC_MARKER = 'zzmedknowdoczz'
+
+# Size of the packs of unique sentences, when pack_chars is not set
+SENTENCE_PACK_CHARS = 5000
+
+
+def packing_enabled():
+    """
+    Whether short documents are packed together into single SemRep inputs,
+    as set by pack_chars in load.semrep.
+    """
+    return bool(settings['load']['semrep'].get('pack_chars'))
+
+
+def semrep_lines(text):
+    """
+    Run SemRep on a piece of text and return its -F output lines. The text
+    goes through the pool of SemRep processes if pool_size is set in
+    load.semrep, or through a new SemRep process otherwise.
+    Input:
+        - text: str,
+        a piece of text, already cleaned with clean_text
+    Output:
+        - lines: iterable,
+        the output lines of the binary
+    """
+    semrep_dir = settings['load']['path']['semrep']
+    pool_size = settings['load']['semrep']['pool_size']
+    if pool_size:
+        return get_semrep_pool(semrep_dir, [SEMREP_BIN] + SEMREP_FLAGS, pool_size).lines(text)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    proc = subprocess.Popen([SEMREP_BIN] + SEMREP_FLAGS, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, cwd=semrep_dir)
+    out, _ = proc.communicate(text + '\n')
+    if proc.returncode != 0:
+        raise IOError('SemRep exited with code %s!' % proc.returncode)
+    return out.splitlines(True)
+
+
+def pack_texts(texts, pack_chars):
+    """
+    Group consecutive texts in packs of up to pack_chars characters. Texts
+    longer than that form a pack of their own.
+    Input:
+        - texts: iterable,
+        the cleaned texts of the documents
+        - pack_chars: int,
+        target number of characters of each pack
+    Output:
+        - generator of the packs, as lists of texts
+    """
+    pack = []
+    size = 0
+    for text in texts:
+        if pack and size + len(text) > pack_chars:
+            yield pack
+            pack = []
+            size = 0
+        pack.append(text)
+        size += len(text)
+    if pack:
+        yield pack
+
+
+def split_packed_lines(lines):
+    """
+    Split the SemRep output of packed documents at the marker sentences,
+    dropping the lines of the markers themselves.
+    Input:
+        - lines: iterable,
+        the -F output lines of the packed input
+    Output:
+        - docs: list,
+        the list of output lines of each document
+    """
+    docs = [[]]
+    skip = False
+    for line in lines:
+        elements = line.split('|')
+        if len(elements) > 6 and elements[5] == 'text':
+            skip = SEMREP_DOC_MARKER in elements[6]
+            if skip:
+                docs.append([])
+        if not skip:
+            docs[-1].append(line)
+    return docs
+
+
+def renumber_sents(results):
+    """
+    Number the sentences of the results of a document consecutively from
+    0, replacing the ids given by SemRep. Every semrep extraction path
+    numbers the sentences of a document this way, so that the same
+    sentence gets the same id whether the document was extracted alone,
+    split, packed or deduplicated.
+    """
+    for sent_id, sent in enumerate(results['sents']):
+        sent['sent_id'] = sent_id
+    return results
+
+
+def semrep_pack(texts):
+    """
+    Extract concepts and relations from a pack of texts with a single
+    SemRep input, the texts separated by marker sentences. The output is
+    split back at the markers and the sentences renumbered per text. Texts
+    found in the result cache are left out of the input.
+    Input:
+        - texts: list,
+        the cleaned texts of the pack
+    Output:
+        - results: list,
+        the results of each text, as returned by semrep_document
+    """
+    store = get_result_cache()
+    cached = [store.get(tool_key('semrep', text)) if store is not None else None for text in texts]
+    todo = [text for text, res in izip(texts, cached) if res is None]
+    if len(todo) > 1:
+        marker = '\n\n%s.\n\n' % SEMREP_DOC_MARKER
+        docs = split_packed_lines(semrep_lines(marker.join(todo)))
+        if len(docs) == len(todo):
+            extracted = [{'sents': parse_semrep_lines(lines), 'text': text}
+                         for text, lines in izip(todo, docs)]
+            if store is not None:
+                for text, res in izip(todo, extracted):
+                    store.put(tool_key('semrep', text), res)
+        else:
+            time_log('Lost the document boundaries of a SemRep pack. Extracting its %d documents one by one'
+                     % len(todo))
+            extracted = [semrep_document(text) for text in todo]
+    else:
+        extracted = [semrep_document(text) for text in todo]
+    extracted = iter(extracted)
+    results = []
+    for text, res in izip(texts, cached):
+        if res is None:
+            res = extracted.next()
+        results.append(renumber_sents(res))
+    return results
+
+
+def semrep_packed_documents(texts, pool=None):
+    """
+    Extract concepts and relations from the cleaned texts of many
+    documents, packing short ones together into single SemRep inputs of
+    about pack_chars characters, check semrep_pack. The packs are spread
+    across the processes given by the workers field of pipeline.trans.
+    Input:
+        - texts: iterable,
+        the cleaned texts of the documents
+        - pool: multiprocessing.Pool,
+        pool of worker processes to use, e.g. from open_worker_pool.
+        Defaults to a pool for this call only
+    Output:
+        - generator of the results of each document, as returned by
+        semrep_document
+    """
+    pack_chars = settings['load']['semrep']['pack_chars']
+    workers = settings['pipeline']['trans'].get('workers', 1) or 1
+    for results in map_documents(semrep_pack, pack_texts(texts, pack_chars), workers, pool, 1):
+        for res in results:
+            yield res
+
+
+def semrep_unique_sentences(texts, pool=None):
+    """
+    Extract concepts and relations from the cleaned texts of many documents
+    sentence by sentence, running SemRep only once for each unique
+    sentence. The results of each sentence are copied to every document
+    it appears in and the sentences of each document renumbered
+    consecutively. The unique sentences are packed into single SemRep
+    inputs of about pack_chars characters (SENTENCE_PACK_CHARS if it is
+    not set), check semrep_pack, and the packs spread across the processes
+    given by the workers field of pipeline.trans in settings.yaml.
+    Input:
+        - texts: iterable,
+        the cleaned texts of the documents
+        - pool: multiprocessing.Pool,
+        pool of worker processes to use, e.g. from open_worker_pool.
+        Defaults to a pool for this call only
+    Output:
+        - generator of the results of each document, as returned by
+        semrep_document
+    """
+    from nltk.tokenize import sent_tokenize
+    texts = list(texts)
+    workers = settings['pipeline']['trans'].get('workers', 1) or 1
+    doc_sents = []
+    unique = {}
+    order = []
+    for text in texts:
+        sents = sent_tokenize(text)
+        for sent in sents:
+            if not(sent in unique):
+                unique[sent] = len(order)
+                order.append(sent)
+        doc_sents.append(sents)
+    time_log('Extracting %d unique sentences out of %d in total' %
+             (len(order), sum(len(sents) for sents in doc_sents)))
+    pack_chars = settings['load']['semrep'].get('pack_chars') or SENTENCE_PACK_CHARS
+    extracted = []
+    for results in map_documents(semrep_pack, pack_texts(order, pack_chars), workers, pool, 1):
+        extracted.extend(res['sents'] for res in results)
+    for text, sents in izip(texts, doc_sents):
+        results = {'text': text, 'sents': []}
+        sent_id = 0
+        for sent in sents:
+            # SemRep may split a sentence further, so one or more of its own
+            for sem_sent in extracted[unique[sent]]:
+                sem_sent = copy.deepcopy(sem_sent)
+                sem_sent['sent_id'] = sent_id
+                sent_id += 1
+                results['sents'].append(sem_sent)
+        yield results
+
+
+def open_worker_pool():
+    """
+    Open the pool of worker processes given by the workers field of
+    pipeline.trans in settings.yaml, to be shared by all the extraction
+    steps of a run and closed with close_worker_pool at its end. Should be
+    called before starting any threads, since the workers are forked from
+    the current process.
+    Output:
+        - pool: multiprocessing.Pool,
+        the pool, or None if a single worker is asked for
+    """
+    workers = settings['pipeline']['trans'].get('workers', 1) or 1
+    if workers > 1:
+        time_log('Starting a pool of %d worker processes' % workers)
+        return multiprocessing.Pool(workers)
+    return None
+
+
+def close_worker_pool(pool):
+    """
+    Stop the worker processes of a pool from open_worker_pool.
+    """
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+def apply_chunk(args):
+    """
+    Worker function of map_documents, applying func to a chunk of texts
+    and then writing the result cache of the worker process.
+    Input:
+        - args: tuple,
+        the function and the list of texts
+    Output:
+        - results: list,
+        the results of func for each text
+    """
+    func, texts = args
+    results = [func(text) for text in texts]
+    flush_result_cache()
+    return results
+
+
+def iter_chunks(items, size):
+    """
+    Split an iterable in lists of up to size consecutive items.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def map_documents(func, texts, workers=1, pool=None, chunk_size=10):
+    """
+    Apply func to each one of the texts. If a pool is given, or more than
+    one workers are asked for, the texts are spread across a pool of
+    processes in chunks of chunk_size texts, check apply_chunk. Either way,
+    the results are yielded in the same order as the texts.
+    Input:
+        - func: function,
+        module-level function taking a text, so that it can be pickled
+        - texts: iterable,
+        the texts to process
+        - workers: int,
+        number of processes to use, when no pool is given
+        - pool: multiprocessing.Pool,
+        pool of worker processes to use, e.g. from open_worker_pool.
+        Defaults to a pool for this call only
+        - chunk_size: int,
+        number of texts sent to a worker process at once
+    Output:
+        - generator of the results of func
+    """
+    if pool is None and workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for res in map_documents(func, texts, workers, pool, chunk_size):
+                yield res
+        finally:
+            close_worker_pool(pool)
+    elif pool is not None:
+        chunks = ((func, chunk) for chunk in iter_chunks(texts, chunk_size))
+        for results in pool.imap(apply_chunk, chunks):
+            for res in results:
+                yield res
+    else:
+        for text in texts:
+            yield func(text)
+
+
+def batch_documents(tool, batch_func, texts, batch_size, pool=None):
+    """
+    Extract many documents with the batch function of a tool. The texts
+    are looked up in the result cache and the rest are split into groups
+    of consecutive documents, of up to batch_size sentences each. When
+    more than one workers are asked for in pipeline.trans, the groups are
+    made small enough to keep all of them busy and are spread across the
+    pool of processes. The result cache is only updated in this process.
+    Input:
+        - tool: str,
+        name of the tool, for the result cache keys
+        - batch_func: function,
+        module-level function taking a list of (text, sentences) tuples
+        and returning the results of each one, e.g. metamap_batch
+        - texts: iterable,
+        the cleaned texts of the documents
+        - batch_size: int,
+        maximum number of sentences in each group
+        - pool: multiprocessing.Pool,
+        pool of worker processes to use, e.g. from open_worker_pool.
+        Defaults to a pool for this call only
+    Output:
+        - generator of the results of each document, in the same order as
+        the texts
+    """
+    from nltk.tokenize import sent_tokenize
+    workers = settings['pipeline']['trans'].get('workers', 1) or 1
+    store = get_result_cache()
+    # Texts with their sentences and cached results, None for the ones to
+    # extract
+    docs = []
+    for text in texts:
+        cached = None
+        if store is not None:
+            cached = store.get(tool_key(tool, text))
+        sents = sent_tokenize(text) if cached is None else None
+        docs.append((text, sents, cached))
+    n_sents = sum(len(sents) for text, sents, cached in docs if cached is None)
+    size = max(min(int(batch_size), -(-n_sents // workers)), 1)
+    groups = []
+    group = []
+    n = 0
+    for doc in docs:
+        group.append(doc)
+        if doc[2] is None:
+            n += len(doc[1])
+        if n >= size:
+            groups.append(group)
+            group = []
+            n = 0
+    if group:
+        groups.append(group)
+    todo = ([(text, sents) for text, sents, cached in group if cached is None]
+            for group in groups)
+    for group, extracted in izip(groups, map_documents(batch_func, todo, workers, pool, 1)):
+        extracted = iter(extracted)
+        for text, sents, cached in group:
+            if cached is None:
+                cached = extracted.next()
+                if store is not None:
+                    store.put(tool_key(tool, text), cached)
+            yield cached
+
+
+def tool_signature(tool):
+    """
+    Describe an external NLP tool, i.e. the binary, its version and the
+    flags it is called with. Cached results are only reused for the same
+    signature, so changing any of them causes the texts to be extracted
+    again.
+    Input:
+        - tool: str,
+        one of semrep, metamap, reverb
+    Output:
+        - signature: str,
+        the description of the tool
+    """
+    if tool == 'semrep':
+        return ' '.join(['semrep', SEMREP_BIN] + SEMREP_FLAGS)
+    elif tool == 'metamap':
+        return ' '.join(['metamap', settings['load']['path']['metamap']])
+    elif tool == 'reverb':
+        return ' '.join(['reverb', settings['load']['path']['reverb'], REVERB_BIN] + REVERB_FLAGS)
+    return tool
+
+
+def extractor_signature(func):
+    """
+    Describe the extractor behind one of the *_document functions, check
+    tool_signature.
+    Input:
+        - func: function,
+        one of the *_document functions
+    Output:
+        - signature: str,
+        the description of the extractor
+    """
+    if func is semrep_document:
+        return tool_signature('semrep')
+    elif func is metamap_document:
+        return tool_signature('metamap')
+    elif func is reverb_document:
+        return tool_signature('reverb')
+    return func.__name__
+
+
+def results_key(doc_id, text, signature):
+    """
+    Key of the stored extraction results of a document. It is a hash of
+    the id of the document, its cleaned text and the extractor signature,
+    so any change in one of them leads to a new key.
+    Input:
+        - doc_id: str,
+        the id of the document, or the tool for the result cache
+        - text: str,
+        the cleaned text of the document
+        - signature: str,
+        as generated by extractor_signature
+    Output:
+        - key: str,
+        hex digest of the hash
+    """
+    h = hashlib.sha1()
+    for part in [doc_id, text, signature]:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        h.update(str(part))
+        h.update('\0')
+    return h.hexdigest()
+
+
+def tool_key(tool, text):
+    """
+    Key of the results of a tool for a text in the result cache, which
+    depends only on the text and not on the document it came from.
+    """
+    return results_key(tool, text, tool_signature(tool))
+
+
+_result_cache = None
+
+
+def get_result_cache():
+    """
+    Open the result cache given by result_cache_path in settings.yaml, or
+    return None if it is disabled. New results and access times are written
+    in batches of cache_batch_size, and at the end of every task of a
+    worker process and every extraction step, check flush_result_cache.
+    """
+    path = settings.get('result_cache_path')
+    if not(path) or str(path) == 'None':
+        return None
+    global _result_cache
+    if _result_cache is None:
+        max_size = int(settings.get('result_cache_size', 1024)) << 20
+        _result_cache = LRUStore(path, table='results', batch_size=settings.get('cache_batch_size', 500),
+                                 max_size=max_size)
+    return _result_cache
+
+
+def flush_result_cache():
+    """
+    Write the pending results and access times of the result cache of this
+    process, if it is open. Worker processes are terminated without closing
+    the cache, so this is called at the end of each of their tasks.
+    """
+    if _result_cache is not None:
+        _result_cache.flush()
+
+
+def cached_result(tool, text, func):
+    """
+    Return the results of an external NLP tool for a text, running func
+    only if they are not found in the result cache.
+    Input:
+        - tool: str,
+        name of the tool, check tool_signature
+        - text: str,
+        the text to extract from
+        - func: function,
+        the function running the tool on the text
+    Output:
+        - results: dic,
+        the results of func
+    """
+    store = get_result_cache()
+    if store is None:
+        return func(text)
+    key = tool_key(tool, text)
+    results = store.get(key)
+    if results is None:
+        results = func(text)
+        store.put(key, results)
+    return results
+
+
+def open_results_store():
+    """
+    Open the store of extraction results given by results_path in
+    settings.yaml, or return None if storing results is disabled.
+    """
+    path = settings.get('results_path')
+    if not(path) or str(path) == 'None':
+        return None
+    return KeyValueStore(path, table='results', batch_size=settings.get('cache_batch_size', 500))
+
+
+def extract_documents(json_, key, func, batch_func=None, pool=None):
+    """
+    Run a document extraction function on every document of json_ and
+    update the documents with its results. The number of processes to use
+    is read from the workers field of pipeline.trans in settings.yaml.
+    If results_path is set, the results are stored by results_key and
+    documents whose id, text and extractor are unchanged since an earlier
+    run reuse their stored results instead of being extracted again.
     Input:
         - json_ : dic,
         json-style dictionary generated from the Parse object related
@@ -510,37 +1244,88 @@ def extract_semrep(json_, key):
         - key : str,
         string denoting the type of medical text to read from. Used to
         find the correct paragraph in the settings.yaml file.
+        - func: function,
+        one of the *_document functions
+        - batch_func: function,
+        optional function taking all the texts at once and yielding the
+        same results as func, e.g. metamap_documents. Used instead of
+        func and spreads the work across the workers itself
+        - pool: multiprocessing.Pool,
+        pool of worker processes shared by the whole run, from
+        open_worker_pool. If None and more than one workers are asked
+        for, a pool is created for this call only
     Output:
         - json_ : dic,
-        the previous json-style dictionary enriched with medical concepts
+        the previous json-style dictionary enriched with the results
     """
     # outerfield for the documents in json
     docfield = settings['out'][key]['json_doc_field']
     # textfield to read text from
     textfield = settings['out'][key]['json_text_field']
-    N = len(json_[docfield])
-    for i, doc in enumerate(json_[docfield]):
-        print doc['id']
-        text = clean_text(doc[textfield])
-        if len(text) > 5000:
-            chunks = create_text_batches(text)
-            results = {'text': text, 'sents': []}
-            sent_id = 0
-            for chunk in chunks:
-                tmp = semrep_wrapper(chunk)
-                for sent in tmp['sents']:
-                    sent['sent_id'] = sent_id
-                    sent_id += 1
-                    results['sents'].append(sent)
-        else:
-            results = semrep_wrapper(text)
-        json_[docfield][i].update(results)
-        proc = int(i/float(N)*100)
+    # idfield of the documents
+    idfield = settings['out'][key].get('json_id_field', 'id')
+    # number of processes to spread the documents to
+    workers = settings['pipeline']['trans'].get('workers', 1) or 1
+    docs = json_[docfield]
+    N = len(docs)
+    texts = [clean_text(doc[textfield]) for doc in docs]
+    store = open_results_store()
+    if store is not None:
+        signature = extractor_signature(func)
+        keys = [results_key(doc.get(idfield, i), texts[i], signature)
+                for i, doc in enumerate(docs)]
+        found = store.get_many(keys)
+        for i, k in enumerate(keys):
+            if k in found:
+                docs[i].update(found[k])
+        todo = [i for i, k in enumerate(keys) if not(k in found)]
+        time_log('Reusing stored results for %d/%d documents' % (N - len(todo), N))
+    else:
+        todo = range(N)
+    if batch_func is not None:
+        extracted = batch_func((texts[i] for i in todo), pool)
+    else:
+        extracted = map_documents(func, (texts[i] for i in todo), workers, pool)
+    for c, (i, results) in enumerate(izip(todo, extracted)):
+        docs[i].update(results)
+        if store is not None:
+            store.put(keys[i], results)
+        proc = int(c/float(len(todo))*100)
         if proc % 10 == 0 and proc > 0:
-            time_log('We are at %d/%d documents -- %0.2f %%' % (i, N, proc))
+            time_log('We are at %d/%d documents -- %0.2f %%' % (c, len(todo), proc))
+    if store is not None:
+        store.close()
+    flush_result_cache()
     return json_
 
 
+def extract_semrep(json_, key, pool=None):
+    """
+    Task function to parse and extract concepts from json_ style dic, using
+    the SemRep binary. If dedupe_sentences is set in pipeline.trans, each
+    unique sentence is extracted only once, check semrep_unique_sentences.
+    Otherwise, if pack_chars is set in load.semrep, short documents are
+    packed together, check semrep_pack.
+    Input:
+        - json_ : dic,
+        json-style dictionary generated from the Parse object related
+        to the specific type of input
+        - key : str,
+        string denoting the type of medical text to read from. Used to
+        find the correct paragraph in the settings.yaml file.
+        - pool: multiprocessing.Pool,
+        pool of worker processes shared by the whole run, or None
+    Output:
+        - json_ : dic,
+        the previous json-style dictionary enriched with medical concepts
+    """
+    if str(settings['pipeline']['trans'].get('dedupe_sentences')) == 'True':
+        return extract_documents(json_, key, semrep_document, semrep_unique_sentences, pool)
+    elif packing_enabled():
+        return extract_documents(json_, key, semrep_document, semrep_packed_documents, pool)
+    return extract_documents(json_, key, semrep_document, pool=pool)
+
+
 def parse_medical_rec():
     """
     Parse file containing medical records.
@@ -559,6 +1344,7 @@ def parse_medical_rec():
     textfield = settings['load']['med_rec']['textfield']
     # idfield where id of document is stored
     idfield = settings['load']['med_rec']['idfield']
+    import pandas as pd
     with open(inp_path, 'r') as f:
         diag = pd.DataFrame.from_csv(f, sep='\t')
     # Get texts
@@ -582,23 +1368,177 @@ def parse_medical_rec():
     return json_
 
 
-def parse_json():
+class JsonStreamReader(object):
     """
-    Parse file containing articles.
+    Incremental reader of json values from a file. The file is read in
+    chunks and values are decoded as soon as they are complete, so only
+    the value being decoded has to fit in memory.
+    """
+
+    def __init__(self, f, chunk_size=1 << 20):
+        """
+        Initialization of the class.
+        Input:
+            - f: file,
+            file object opened for reading
+            - chunk_size: int,
+            number of bytes to read each time more data is needed
+        """
+
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Read the next chunk of the file, dropping what was already consumed.
+        Returns False at the end of the file.
+        """
+
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, or '' at the end
+        of the file.
+        """
+
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        """
+        Consume the next character, which must be one of chars, and
+        return it.
+        """
+
+        c = self.peek()
+        if not c or not(c in chars):
+            raise ValueError('Expected one of %s at offset %d, found %r' % (chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        Decode and return the next json value.
+        """
+
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number may continue in the next chunk, so a value is
+                # complete only when followed by a delimiter
+                if self.eof or (end < len(self.buf) and self.buf[end] in ' \t\n\r,:]}'):
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_json_array(f, field, chunk_size=1 << 20):
+    """
+    Yield one at a time the elements of the array found in field of the
+    outer json object of a file, without loading the whole file. The
+    values of the other outer fields are decoded and skipped.
+    Input:
+        - f: file,
+        file object opened for reading
+        - field: str,
+        name of the outer field containing the array
+        - chunk_size: int,
+        number of bytes read from the file at once
     Output:
-        - json_ : dic,
-        json-style dictionary with documents containing
-        a list of dicts, with field text, containing the attributes of
-        the article
+        - generator of the elements of the array
     """
+    reader = JsonStreamReader(f, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == field and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            reader.value()
+        if reader.expect(',}') == '}':
+            break
 
-    # input file path from settings.yaml
-    inp_path = settings['load']['json']['inp_path']
+
+def iter_json_lines(f):
+    """
+    Yield the json objects of a JSON Lines file, one per line.
+    Input:
+        - f: file,
+        file object opened for reading
+    Output:
+        - generator of the objects found
+    """
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_json_file(inp_path, field):
+    """
+    Stream the elements of a json input file. Files ending in .jsonl or
+    .ndjson are read as JSON Lines, with one element per line. Otherwise,
+    the elements of the array in field of the outer object are streamed.
+    Input:
+        - inp_path: str,
+        path to the input file
+        - field: str,
+        name of the outer field containing the elements
+    Output:
+        - generator of the elements found
+    """
     with open(inp_path, 'r') as f:
-        json_ = json.load(f, encoding='utf-8')
+        if os.path.splitext(inp_path)[1] in ['.jsonl', '.ndjson']:
+            for elem in iter_json_lines(f):
+                yield elem
+        else:
+            for elem in iter_json_array(f, field):
+                yield elem
+
+
+def normalize_article(article):
+    """
+    Rename the fields of an article from the names found in the load.json
+    settings to the ones used in out.json.
+    Input:
+        - article: dic,
+        the article as found in the input file
+    Output:
+        - article: dic,
+        the same article with renamed fields, or None if the article has
+        no text field
+    """
 
-    # docfield containing list of elements containing text
-    outfield = settings['load']['json']['docfield']
     # textfield to read text from
     textfield = settings['load']['json']['textfield']
     # idfield where id of document is stored
@@ -608,31 +1548,69 @@ def parse_json():
     
     ## Values to replace them with ##
 
-    # docfield containing list of elements
-    out_outfield = settings['out']['json']['json_doc_field']
     # textfield to read text from
     out_textfield = settings['out']['json']['json_text_field']
     # labelfield where title of the document is stored
     out_labelfield = settings['out']['json']['json_label_field']
-    json_[outfield] = [art for art in json_[outfield] if textfield in art.keys()]
-    for article in json_[outfield]:
-        if not(textfield in article.keys()):
-            continue
-        article[out_textfield] = article.pop(textfield)
-        article['id'] = article.pop(idfield)
-        if labelfield != 'None':
-            article[out_labelfield] = article.pop(labelfield)
-        else:
-            article[out_labelfield] = ' '
-        if not('journal' in article.keys()):
-            article['journal'] = 'None'
-    json_[out_outfield] = json_.pop(outfield)
-    # N = len(json_[out_outfield])
-    # json_[out_outfield] = json_[out_outfield][(2*N/5):(3*N/5)]
-    json_[out_outfield] = json_[out_outfield][:]
+    if not(textfield in article.keys()):
+        return None
+    article[out_textfield] = article.pop(textfield)
+    article['id'] = article.pop(idfield)
+    if labelfield != 'None':
+        article[out_labelfield] = article.pop(labelfield)
+    else:
+        article[out_labelfield] = ' '
+    if not('journal' in article.keys()):
+        article['journal'] = 'None'
+    return article
+
+
+def parse_json():
+    """
+    Parse file containing articles.
+    Output:
+        - json_ : dic,
+        json-style dictionary with documents containing
+        a list of dicts, with field text, containing the attributes of
+        the article
+    """
+
+    # input file path from settings.yaml
+    inp_path = settings['load']['json']['inp_path']
+    # docfield containing list of elements containing text
+    outfield = settings['load']['json']['docfield']
+    # docfield containing list of elements
+    out_outfield = settings['out']['json']['json_doc_field']
+    if os.path.splitext(inp_path)[1] in ['.jsonl', '.ndjson']:
+        json_ = {outfield: list(iter_json_file(inp_path, outfield))}
+    else:
+        with open(inp_path, 'r') as f:
+            json_ = json.load(f, encoding='utf-8')
+    articles = [normalize_article(art) for art in json_.pop(outfield)]
+    json_[out_outfield] = [art for art in articles if art is not None]
     return json_
 
 
+def stream_json():
+    """
+    Streaming version of parse_json. The articles are read incrementally
+    from the input file and yielded one at a time, so memory stays flat
+    regardless of the size of the file.
+    Output:
+        - generator of the articles, with the same fields as the
+        documents returned by parse_json
+    """
+
+    # input file path from settings.yaml
+    inp_path = settings['load']['json']['inp_path']
+    # docfield containing list of elements containing text
+    outfield = settings['load']['json']['docfield']
+    for article in iter_json_file(inp_path, outfield):
+        article = normalize_article(article)
+        if article is not None:
+            yield article
+
+
 def parse_edges():
     """
     Parse file containing edges-relations between nodes.
@@ -644,11 +1622,30 @@ def parse_edges():
 
     # input file path from settings.yaml
     inp_path = settings['load']['edges']['inp_path']
+    if os.path.splitext(inp_path)[1] in ['.jsonl', '.ndjson']:
+        outfield = settings['load']['edges']['edge_field']
+        return {outfield: list(iter_json_file(inp_path, outfield))}
     with open(inp_path, 'r') as f:
         json_ = json.load(f, encoding='utf-8')
     return json_
 
 
+def stream_edges():
+    """
+    Streaming version of parse_edges, yielding the edges found in the
+    edge_field of the input file one at a time.
+    Output:
+        - generator of the edges
+    """
+
+    # input file path from settings.yaml
+    inp_path = settings['load']['edges']['inp_path']
+    # field where the edges are stored
+    outfield = settings['load']['edges']['edge_field']
+    for edge in iter_json_file(inp_path, outfield):
+        yield edge
+
+
 def get_concepts_from_edges(json_, key):
     """
     Get concept-specific info related to an entity from a list
@@ -683,21 +1680,25 @@ def get_concepts_from_edges(json_, key):
     obj_source = settings['load'][key]['obj_source']
     new_relations = []
     # Cache used to avoid retrieving the same concepts
-    try:
-        with open(settings['cache_path'], 'r') as f:
-            cache = json.load(f)
-    except IOError:
-        cache = {}
+    cache = open_cache(settings['cache_path'], settings['cache_batch_size'])
+    # Resolve all the cuis missing from the cache in bulk, before the loop
+    cuis = set()
+    if sub_source == 'UMLS':
+        cuis.update(triple['s'] for triple in json_[outfield])
+    if obj_source == 'UMLS':
+        cuis.update(triple['o'] for triple in json_[outfield])
+    if cuis:
+        cached = cache.get_many(cuis)
+        found = get_umls_client().resolve_many(cui for cui in cuis if not(cui in cached))
+        cache.put_many((cui, ent) for cui, ent in found.iteritems() if ent is not None)
     N = len(json_[outfield])
     for ii, triple in enumerate(json_[outfield]):
-        print triple
         try:
             if sub_source == 'UMLS':
-                if not(triple['s'] in cache):
+                ent = cache.get(triple['s'])
+                if ent is None:
                     ent = get_concept_from_cui(triple['s'])
-                    cache[triple['s']] = ent
-                else:
-                    ent = cache[triple['s']]
+                    cache.put(triple['s'], ent)
                 if (type(ent['sem_types']) == list and len(ent['sem_types']) > 1):
                     sem_types = ';'.join(ent['sem_types'])
                 elif (',' in ent['sem_types']):
@@ -711,11 +1712,10 @@ def get_concepts_from_edges(json_, key):
             elif (sub_source == 'PMC') or (sub_source == 'TEXT') or (sub_source == 'None'):
                 triple_subj = [{'id:ID': triple['s']}]
             else:
-                if not(triple['s'] in cache):
+                ents = cache.get(triple['s'])
+                if ents is None:
                     ents = get_concept_from_source(triple['s'], sub_source)
-                    cache[triple['s']] = ents
-                else:
-                    ents = cache[triple['s']]
+                    cache.put(triple['s'], ents)
                 triple_subj = []
                 for ent in ents:
                     if (type(ent['sem_types']) == list and len(ent['sem_types']) > 1):
@@ -729,11 +1729,10 @@ def get_concepts_from_edges(json_, key):
                                     'label': ent['label'], 
                                     'sem_types:string[]': sem_types})
             if obj_source == 'UMLS':
-                if not(triple['o'] in cache):
+                ent = cache.get(triple['o'])
+                if ent is None:
                     ent = get_concept_from_cui(triple['o'])
-                    cache[triple['o']] = ent
-                else:
-                    ent = cache[triple['o']]
+                    cache.put(triple['o'], ent)
                 if (type(ent['sem_types']) == list and len(ent['sem_types']) > 1):
                     sem_types = ';'.join(ent['sem_types'])
                 elif (',' in ent['sem_types']):
@@ -746,11 +1745,10 @@ def get_concepts_from_edges(json_, key):
             elif (obj_source == 'PMC') or (obj_source == 'TEXT') or (obj_source == 'None'):
                 triple_obj = [{'id:ID': triple['o']}]
             else:
-                if not(triple['o'] in cache):
+                ents = cache.get(triple['o'])
+                if ents is None:
                     ents = get_concept_from_source(triple['o'], obj_source)
-                    cache[triple['o']] = ents
-                else:
-                    ents = cache[triple['o']]
+                    cache.put(triple['o'], ents)
                 triple_obj = []
                 for ent in ents:
                     if (type(ent['sem_types']) == list and len(ent['sem_types']) > 1):
@@ -772,9 +1770,8 @@ def get_concepts_from_edges(json_, key):
         proc = int(ii/float(N)*100)
         if proc % 10 == 0 and proc > 0:
             time_log('We are at %d/%d edges transformed -- %0.2f %%' % (ii, N, proc))
-        with open(settings['cache_path'], 'w+') as f:
-            json.dump(cache, f, indent=2)
         # if ii % 100 == 0 and ii > 9:
         #     time_log("Edges Transformation Process: %d -- %0.2f %%" % (ii, 100*ii/float(len(json_[outfield]))))
+    cache.close()
     json_[outfield] = new_relations
     return json_
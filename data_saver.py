@@ -8,24 +8,60 @@
 
 import json
 import os
-import py2neo
+import re
+import gzip
+import atexit
 import csv
 import subprocess
 import urllib2
 import requests
 import unicodecsv as csv2
-import pandas as pd
-import py2neo
 import logging
-import pymongo
 from config import settings
 from utilities import time_log
 
 
-suppress_log_to_file = py2neo.watch('neo4j',
-                                    level='ERROR', out='./out/neo4j.log')
-suppress_log_to_file2 = py2neo.watch('httpstream',
-                                    level='ERROR', out='./out/neo4j.log')
+# Connections opened by the dumpers, kept open to be reused in every call
+_connections = {}
+
+
+def get_graph():
+    """
+    Get the neo4j graph described in the neo4j settings. The connection is
+    opened on the first call and reused afterwards.
+    Output:
+        - graph: py2neo.Graph,
+        object representing the graph in neo4j
+    """
+    if not('neo4j' in _connections):
+        import py2neo
+        py2neo.watch('neo4j', level='ERROR', out='./out/neo4j.log')
+        py2neo.watch('httpstream', level='ERROR', out='./out/neo4j.log')
+        host = settings['neo4j']['host']
+        port = settings['neo4j']['port']
+        user = settings['neo4j']['user']
+        password = settings['neo4j']['password']
+        _connections['neo4j'] = py2neo.Graph(host=host, port=port, user=user, password=password)
+    return _connections['neo4j']
+
+
+def get_mongo_collection():
+    """
+    Get the mongodb collection described in the mongo settings. The client
+    is created on the first call and reused afterwards.
+    Output:
+        - collection: pymongo.collection.Collection,
+        the collection to save the sentences in
+    """
+    if not('mongo' in _connections):
+        import pymongo
+        uri = settings['mongo']['uri']
+        db_name = settings['mongo']['db']
+        collection_name = settings['mongo']['collection']
+        client = pymongo.MongoClient(uri)
+        _connections['mongo'] = client[db_name][collection_name]
+    return _connections['mongo']
+
 
 def save_json2(json_):
     """
@@ -43,15 +79,22 @@ def save_json2(json_):
 
 def save_json(json_):
     """
-    Helper function to save enriched medical json to file
-.    Input:
+    Helper function to save enriched medical json to file. If format
+    is jsonl in the out.json settings, the documents are appended to
+    a JSON Lines file instead of rewriting the whole output.
+    Input:
         - json_: dic,
         json-style dictionary generated from the extractors in the
         previous phase
+    Output: None, writes the documents to out_path in either format.
     """
 
     # Output file location from settings
     outfile = settings['out']['json']['out_path']
+    if settings['out']['json']['format'] == 'jsonl':
+        writer = get_jsonl_writer(outfile)
+        writer.write(json_[settings['out']['json']['json_doc_field']])
+        return
     if os.path.isfile(outfile):
         with open(outfile, 'r') as f:
             docs1 = json.load(f)[settings['out']['json']['json_doc_field']]
@@ -67,9 +110,181 @@ def save_json(json_):
     
     # with open(outfile, 'a+') as f:
     #     json1 = json.load(f)
-        
 
 
+class JsonlWriter(object):
+    """
+    Append-only writer of documents to a JSON Lines file, optionally
+    compressed with gzip or zstd. The file is kept open between calls and
+    synced to disk every fsync_every documents, so that appending a
+    document costs the same regardless of the size of the file.
+    """
+
+    def __init__(self, path, compression=None, fsync_every=100):
+        """
+        Initialization of the class.
+        Input:
+            - path: str,
+            path to the output file. Existing content is kept
+            - compression: str,
+            None, gzip or zstd
+            - fsync_every: int,
+            number of documents written between two syncs to disk
+        """
+
+        self.path = path
+        self.compression = compression
+        self.fsync_every = fsync_every
+        self.unsynced = 0
+        self.raw = open(path, 'ab')
+        if compression == 'gzip':
+            # Each run appends a new gzip member, which gzip reads through
+            self.f = gzip.GzipFile(fileobj=self.raw, mode='ab')
+        elif compression == 'zstd':
+            import zstandard
+            self.f = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.f = self.raw
+
+    def write(self, docs):
+        """
+        Append documents to the file, one json object per line.
+        Input:
+            - docs: list,
+            list of the documents to write
+        """
+
+        for doc in docs:
+            self.f.write(json.dumps(doc) + '\n')
+        self.unsynced += len(docs)
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush the written documents and sync them to disk.
+        """
+
+        if self.compression == 'zstd':
+            import zstandard
+            # Ends the current frame, so that everything written so far
+            # can be decompressed
+            self.f.flush(zstandard.FLUSH_FRAME)
+        elif self.f is not self.raw:
+            self.f.flush()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        """
+        Sync and close the file.
+        """
+
+        self.sync()
+        if self.compression == 'gzip':
+            self.f.close()
+        self.raw.close()
+
+
+_jsonl_writers = {}
+
+
+def get_jsonl_writer(path):
+    """
+    Get the JsonlWriter of path, opening it on the first call with the
+    compression and fsync_every of the out.json settings.
+    """
+    if not(path in _jsonl_writers):
+        compression = settings['out']['json']['compression']
+        if compression == 'None':
+            compression = None
+        _jsonl_writers[path] = JsonlWriter(path, compression, settings['out']['json']['fsync_every'])
+    return _jsonl_writers[path]
+
+
+def close_jsonl_writers():
+    """
+    Close all the open JsonlWriters.
+    """
+    for writer in _jsonl_writers.values():
+        writer.close()
+    _jsonl_writers.clear()
+
+
+atexit.register(close_jsonl_writers)
+
+
+def open_jsonl(path):
+    """
+    Open a JSON Lines file for reading, decompressing it according to its
+    extension (.gz or .zst).
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+    return open(path, 'rb')
+
+
+def iter_lines(f, chunk_size=1 << 20):
+    """
+    Yield the lines of a file object reading it in chunks, as the zstd
+    reader doesn't support readline.
+    """
+    rest = ''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        lines = (rest + data).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def jsonl_to_json(inp_path, out_path, doc_field=None):
+    """
+    Convert a JSON Lines output, as written by save_json with format jsonl,
+    to the legacy json envelope {doc_field: [...]}. Documents are copied
+    one at a time, so the whole output never has to fit in memory.
+    Input:
+        - inp_path: str,
+        path to the JSON Lines file. Compressed files must end in .gz or
+        .zst
+        - out_path: str,
+        path to the json file to create
+        - doc_field: str,
+        outer field of the documents. Defaults to json_doc_field of the
+        out.json settings
+    Output:
+        - c: int,
+        the number of converted documents
+    """
+    if doc_field is None:
+        doc_field = settings['out']['json']['json_doc_field']
+    c = 0
+    f_in = open_jsonl(inp_path)
+    try:
+        with open(out_path, 'w+') as f_out:
+            f_out.write('{%s: [' % json.dumps(doc_field))
+            for line in iter_lines(f_in):
+                line = line.strip()
+                if not line:
+                    continue
+                if c > 0:
+                    f_out.write(',\n')
+                f_out.write(line)
+                c += 1
+            f_out.write(']}\n')
+    finally:
+        f_in.close()
+    time_log('Converted %d documents from %s to %s' % (c, inp_path, out_path))
+    return c
+
 
 def save_csv(json_):
     """
@@ -101,9 +316,46 @@ def save_neo4j(json_):
     with open(outfile, 'w+') as f:
         json.dump(json_, f, indent=3)
 
+def split_array(value):
+    """
+    Helper function to get the elements of an array field of the nodes and
+    edges generated by the create_neo4j_ functions. The field is either a
+    list already, as kept by the aggregate_ functions, or a ;-delimited
+    string.
+    Input:
+        - value: list or str,
+        the value of the field
+    Output:
+        - list of the elements of the array
+    """
+    if isinstance(value, list):
+        return value
+    return value.split(';')
+
+
+def to_array_fields(edge):
+    """
+    Helper function to copy an edge turning its array fields (the ones
+    with a [] type) into lists.
+    """
+    return dict((key, list(split_array(value)) if '[]' in key else value)
+                for key, value in edge.iteritems())
+
+
+def join_arrays(row):
+    """
+    Helper function to copy a node or edge joining its list fields into
+    the ;-delimited strings used in the .csv files.
+    """
+    return dict((key, ';'.join([unicode(v) for v in value]) if isinstance(value, list) else value)
+                for key, value in row.iteritems())
+
+
 def aggregate_mentions(entity_pmc_edges):
     """
     Function to aggregate recurring entity:MENTIONED_IN:pmc relations.
+    The array fields of the aggregated edges are kept as lists and only
+    joined to ;-delimited strings when written out (check join_arrays).
     Input:
         - entity_pmc_edges: list,
         list of dicts as generated by create_neo4j_ functions
@@ -112,28 +364,27 @@ def aggregate_mentions(entity_pmc_edges):
         list of dicts with aggregated values in identical ages
     """
     uniques = {}
+    order = []
     c = 0
     for edge in entity_pmc_edges:
-        cur_key = str(edge[':START_ID'])+'_'+str(edge[':END_ID'])
-        flag = False
+        cur_key = (edge[':START_ID'], edge[':END_ID'])
         if cur_key in uniques:
-            uniques[cur_key]['score:float[]'] = uniques[cur_key]['score:float[]']+';'+edge['score:float[]']
-            uniques[cur_key]['sent_id:string[]'] = uniques[cur_key]['sent_id:string[]']+';'+edge['sent_id:string[]']
-            flag = True
-        else:
-            uniques[cur_key] = edge
-        if flag:
+            uniques[cur_key]['score:float[]'].extend(split_array(edge['score:float[]']))
+            uniques[cur_key]['sent_id:string[]'].extend(split_array(edge['sent_id:string[]']))
             c += 1
-    un_list = []
+        else:
+            uniques[cur_key] = to_array_fields(edge)
+            order.append(cur_key)
     time_log('Aggregated %d mentions from %d in total' % (c, len(entity_pmc_edges)))
-    for k, v in uniques.iteritems():
-        un_list.append(v)
-    return un_list
+    return [uniques[k] for k in order]
 
 
 def aggregate_relations(relations_edges):
     """
     Function to aggregate recurring entity:SEMREP_RELATION:entity relations.
+    An edge is merged only if its sentence is not already part of the
+    aggregated edge. The array fields are kept as lists, check
+    aggregate_mentions.
     Input:
         - relations_edges: list,
         list of dicts as generated by create_neo4j_ functions
@@ -142,25 +393,48 @@ def aggregate_relations(relations_edges):
         list of dicts with aggregated values in identical ages
     """
     uniques = {}
+    # Sentence ids of each aggregated edge, for exact duplicate checks
+    sent_ids = {}
+    order = []
     c = 0
     for edge in relations_edges:
-        cur_key = str(edge[':START_ID'])+'_'+str(edge[':TYPE'])+'_'+str(edge[':END_ID'])
-        flag = False
-        if cur_key in uniques:
-            if not(edge['sent_id:string[]'] in uniques[cur_key]['sent_id:string[]']):
-                for field in edge.keys():
-                    if not(field in [':START_ID', ':TYPE', ':END_ID']):
-                        uniques[cur_key][field] = uniques[cur_key][field]+';'+edge[field]
-                flag = True
-        else:
-            uniques[cur_key] = edge
-        if flag:
+        if merge_relation(edge, uniques, sent_ids, order):
             c += 1
-    un_list = []
     time_log('Aggregated %d relations from %d in total' % (c, len(relations_edges)))
-    for k, v in uniques.iteritems():
-        un_list.append(v)
-    return un_list
+    return [uniques[k] for k in order]
+
+
+def merge_relation(edge, uniques, sent_ids, order):
+    """
+    Helper function of aggregate_relations, adding an edge to the
+    aggregated ones. The edge is merged into the one with the same start,
+    type and end, if its sentence is not already part of it.
+    Input:
+        - edge: dic,
+        the edge to add, as generated by create_neo4j_ functions
+        - uniques: dic,
+        the aggregated edges, keyed by (start, type, end)
+        - sent_ids: dic,
+        the set of sentence ids of each aggregated edge
+        - order: list,
+        the keys of the aggregated edges, in the order first seen
+    Output:
+        - True if the edge was merged into an existing one
+    """
+    cur_key = (edge[':START_ID'], edge[':TYPE'], edge[':END_ID'])
+    edge_sents = split_array(edge['sent_id:string[]'])
+    if cur_key in uniques:
+        if not(sent_ids[cur_key].issuperset(edge_sents)):
+            for field in edge.keys():
+                if not(field in [':START_ID', ':TYPE', ':END_ID']):
+                    uniques[cur_key][field].extend(split_array(edge[field]))
+            sent_ids[cur_key].update(edge_sents)
+            return True
+    else:
+        uniques[cur_key] = to_array_fields(edge)
+        sent_ids[cur_key] = set(edge_sents)
+        order.append(cur_key)
+    return False
 
 
 def create_neo4j_results(json_, key='harvester'):
@@ -189,6 +463,41 @@ def create_neo4j_results(json_, key='harvester'):
         raise NotImplementedError
     return results
 
+def intern_id(id_, ids):
+    """
+    Helper function returning a single shared instance of each node id,
+    so that ids repeated in millions of edges are kept in memory once.
+    Input:
+        - id_: str,
+        the id of a node
+        - ids: dic,
+        dictionary of the ids seen so far, mapping each id to itself
+    Output:
+        - the shared instance of id_
+    """
+    return ids.setdefault(id_, id_)
+
+
+def add_unique_node(node, id_, nodes, seen):
+    """
+    Helper function to append a node to a list of nodes, unless a node
+    with the same id has already been added. The ids added are kept in
+    the seen set, so the check doesn't depend on the length of the list.
+    Input:
+        - node: dic,
+        the node to add
+        - id_: str,
+        the id of the node
+        - nodes: list,
+        list of the unique nodes
+        - seen: set,
+        set of the ids of the nodes in the list
+    """
+    if not(id_ in seen):
+        seen.add(id_)
+        nodes.append(node)
+
+
 def create_neo4j_edges(json_):
     """
     Function that takes the edges file as provided and generates the nodes
@@ -222,29 +531,28 @@ def create_neo4j_edges(json_):
     articles_nodes = []
     other_nodes_sub = []
     other_nodes_obj = []
+    # Ids of the nodes already kept for each list
+    seen = {'Entity': set(), 'Article': set(), 'sub': set(), 'obj': set()}
+    ids = {}
 
     for edge in json_[edgefield]:
+        sub_id = intern_id(edge['s']['id:ID'], ids)
+        obj_id = intern_id(edge['o']['id:ID'], ids)
         if sub_type == 'Entity':
-            if not(edge['s'] in entities_nodes):
-                entities_nodes.append(edge['s'])
+            add_unique_node(edge['s'], sub_id, entities_nodes, seen['Entity'])
         elif sub_type == 'Article':
-            if not(edge['s'] in articles_nodes):
-                articles_nodes.append(edge['s'])
+            add_unique_node(edge['s'], sub_id, articles_nodes, seen['Article'])
         else:
-            if not(edge['s'] in other_nodes_sub):
-                other_nodes_sub.append(edge['s'])
+            add_unique_node(edge['s'], sub_id, other_nodes_sub, seen['sub'])
         if obj_type == 'Entity':
-            if not(edge['o'] in entities_nodes):
-                entities_nodes.append(edge['o'])
+            add_unique_node(edge['o'], obj_id, entities_nodes, seen['Entity'])
         elif obj_type == 'Article':
-            if not(edge['o'] in articles_nodes):
-                articles_nodes.append(edge['o'])
+            add_unique_node(edge['o'], obj_id, articles_nodes, seen['Article'])
         else:
-            if not(edge['o'] in other_nodes_obj):
-                other_nodes_obj.append(edge['o'])
+            add_unique_node(edge['o'], obj_id, other_nodes_obj, seen['obj'])
         #sub_id_key = next((key for key in edge['s'].keys() if ':ID' in key), None)
         #obj_id_key = next((key for key in edge['o'].keys() if ':ID' in key), None)
-        results['edges'][0]['values'].append({':START_ID':edge['s']['id:ID'], ':TYPE':edge['p'], ':END_ID':edge['o']['id:ID']})
+        results['edges'][0]['values'].append({':START_ID':sub_id, ':TYPE':edge['p'], ':END_ID':obj_id})
     if entities_nodes:
         results['nodes'].append({'type': 'Entity', 'values': entities_nodes})
     if articles_nodes:
@@ -290,16 +598,18 @@ def create_neo4j_harvester(json_):
     articles_nodes = []
     entity_pmc_edges = []
     relations_edges = []
-    unique_cuis = []
+    unique_cuis = set()
+    ids = {}
     for doc in json_[out_outfield]:
-        pmid = doc[out_idfield]
+        pmid = intern_id(doc[out_idfield], ids)
         for sent in doc['sents']:
             cur_sent_id = str(pmid)+'_' + str(sent_prefix) + '_' +  str(sent['sent_id'])
             unique_sent[cur_sent_id] = sent['sent_text']
             for ent in sent['entities']:
                 if ent['cuid']:
-                    if not(ent['cuid'] in unique_cuis):
-                        unique_cuis.append(ent['cuid'])
+                    cuid = intern_id(ent['cuid'], ids)
+                    if not(cuid in unique_cuis):
+                        unique_cuis.add(cuid)
                         if (type(ent['sem_types']) == list and len(ent['sem_types']) > 1):
                             sem_types = ';'.join(ent['sem_types'])
                         elif (',' in ent['sem_types']):
@@ -307,16 +617,16 @@ def create_neo4j_harvester(json_):
                         else:
                             sem_types = ent['sem_types']
                         #if not(ent['cuid']):
-                        entities_nodes.append({'id:ID': ent['cuid'], 
+                        entities_nodes.append({'id:ID': cuid, 
                                          'label': ent['label'], 
                                          'sem_types:string[]': sem_types})
-                    entity_pmc_edges.append({':START_ID': ent['cuid'],
+                    entity_pmc_edges.append({':START_ID': cuid,
                                              'score:float[]': ent['score'],
                                              'sent_id:string[]': cur_sent_id,
                                              ':END_ID': pmid})
             for rel in sent['relations']:
                 if rel['subject__cui'] and rel['object__cui']:
-                    relations_edges.append({':START_ID': rel['subject__cui'],
+                    relations_edges.append({':START_ID': intern_id(rel['subject__cui'], ids),
                                      'subject_score:float[]': rel['subject__score'],
                                      'subject_sem_type:string[]': rel['subject__sem_type'],
                                      ':TYPE': rel['predicate'].replace('(','__').replace(')','__'),
@@ -325,7 +635,7 @@ def create_neo4j_harvester(json_):
                                      'object_sem_type:string[]': rel['object__sem_type'],
                                      'sent_id:string[]': cur_sent_id,
                                      'negation:string[]': rel['negation'],
-                                     ':END_ID': rel['object__cui']})            
+                                     ':END_ID': intern_id(rel['object__cui'], ids)})            
         articles_nodes.append({'id:ID': doc[out_idfield], 
                                'title': doc[out_labelfield], 
                                'journal': doc['journal']})
@@ -337,10 +647,208 @@ def create_neo4j_harvester(json_):
     return results
 
 
+# Header fields of the .csv files, for each group of nodes and edges
+CSV_FIELDS = {
+    'entities': ['id:ID', 'label', 'sem_types:string[]'],
+    'articles': ['id:ID', 'title', 'journal'],
+    'entities_pmc': [':START_ID', 'score:float[]', 'sent_id:string[]', ':END_ID', ':TYPE'],
+    'relations': [':START_ID', 'subject_score:float[]', 'subject_sem_type:string[]', ':TYPE', 'pred_type:string[]',
+                  'object_score:float[]', 'object_sem_type:string[]', 'sent_id:string[]', 'negation:string[]', ':END_ID'],
+    'other_edges': [':START_ID', ':TYPE', ':END_ID']
+}
+
+
+class Neo4jCsvWriter(object):
+    """
+    Streaming writer of the node and relationship files used by the
+    neo4j-admin import tool. Each group of nodes/edges gets a header file
+    and numbered part files of up to part_size rows, which are appended to
+    on every call, so the results don't have to be kept in memory. The
+    exception are the relations between entities, which repeat across
+    batches and are aggregated over the whole run, check aggregate_relations.
+    They are only written when the writer is closed. An import.sh script
+    loading all the files written so far is kept next to them.
+    """
+
+    def __init__(self, outpath, part_size=1000000):
+        """
+        Initialization of the class. Files left in outpath by a previous
+        run are removed.
+        Input:
+            - outpath: str,
+            directory to write the files in
+            - part_size: int,
+            maximum number of rows in each part file
+        """
+
+        self.outpath = outpath
+        self.part_size = part_size
+        # group -> [kind, label, fields, list of part files, open file, csv writer, rows in open part]
+        self.groups = {}
+        # Ids of the nodes written so far, as nodes repeat across calls, and
+        # (entity, article) keys of the mentions written so far, as a
+        # document given twice repeats its mentions
+        self.seen = {}
+        # Relations aggregated so far, check merge_relation
+        self.relations = ({}, {}, [])
+        if not os.path.isdir(outpath):
+            os.makedirs(outpath)
+        for filename in os.listdir(outpath):
+            if filename.endswith('.csv') and ('-header' in filename or '-part' in filename):
+                os.remove(os.path.join(outpath, filename))
+
+    def open_group(self, group, kind, label, fields):
+        """
+        Create the header file of a group of nodes or edges.
+        """
+
+        header = os.path.join(self.outpath, '%s-header.csv' % group)
+        with open(header, 'wb') as f:
+            csv2.writer(f, encoding='utf-8').writerow(fields)
+        self.groups[group] = [kind, label, fields, [], None, None, 0]
+        time_log("Created file %s" % os.path.basename(header))
+
+    def write_rows(self, group, rows):
+        """
+        Append rows to the part files of a group, opening a new part every
+        part_size rows.
+        """
+
+        info = self.groups[group]
+        for row in rows:
+            if info[4] is None or info[6] >= self.part_size:
+                if info[4] is not None:
+                    info[4].close()
+                path = os.path.join(self.outpath, '%s-part%03d.csv' % (group, len(info[3])))
+                info[3].append(path)
+                info[4] = open(path, 'wb')
+                info[5] = csv2.DictWriter(info[4], fieldnames=info[2], encoding='utf-8',
+                                          extrasaction='ignore')
+                info[6] = 0
+            info[5].writerow(join_arrays(row))
+            info[6] += 1
+
+    def write(self, results):
+        """
+        Append the nodes and edges of results to the files.
+        Input:
+            - results: dic,
+            json-style dictionary. Check create_neo4j_ function output for
+            details
+        """
+
+        for nodes in results['nodes']:
+            if nodes['type'] == 'Entity':
+                group = 'entities'
+            elif nodes['type'] == 'Article':
+                group = 'articles'
+            else:
+                group = 'nodes_%s' % nodes['type']
+            if not(group in self.groups):
+                self.open_group(group, 'nodes', nodes['type'], CSV_FIELDS.get(group, ['id:ID']))
+                self.seen[group] = set()
+            seen = self.seen[group]
+            new_nodes = []
+            for node in nodes['values']:
+                if not(node['id:ID'] in seen):
+                    seen.add(node['id:ID'])
+                    new_nodes.append(node)
+            self.write_rows(group, new_nodes)
+        for edges in results['edges']:
+            if edges['type'] == 'relation':
+                if not('relations' in self.groups):
+                    self.open_group('relations', 'relationships', None, CSV_FIELDS['relations'])
+                for edge in edges['values']:
+                    merge_relation(edge, *self.relations)
+                continue
+            elif edges['type'] == 'mention':
+                group = 'entities_pmc'
+                seen = self.seen.setdefault(group, set())
+                rows = []
+                for edge in edges['values']:
+                    key = (edge[':START_ID'], edge[':END_ID'])
+                    if not(key in seen):
+                        seen.add(key)
+                        rows.append(dict(edge, **{':TYPE': 'MENTIONED_IN'}))
+            else:
+                group = 'other_edges'
+                rows = edges['values']
+            if not(group in self.groups):
+                self.open_group(group, 'relationships', None, CSV_FIELDS[group])
+            self.write_rows(group, rows)
+        for info in self.groups.values():
+            if info[4] is not None:
+                info[4].flush()
+        self.write_manifest()
+
+    def write_manifest(self):
+        """
+        Write the import.sh script loading all the files written so far
+        into an empty database with neo4j-admin import, using the options
+        of Neo4j 3.x, the version targeted along with py2neo v3.
+        """
+
+        neo4j_admin = settings['out']['csv'].get('neo4j_admin', 'neo4j-admin')
+        database = settings['out']['csv'].get('database', 'graph.db')
+        lines = ['#!/bin/sh', '# Load the files in this directory into an empty database',
+                 'cd "$(dirname "$0")"', '%s import --database=%s \\' % (neo4j_admin, database),
+                 '    --id-type=STRING --array-delimiter=";" --multiline-fields=true \\']
+        for group, info in sorted(self.groups.iteritems()):
+            if not info[3]:
+                continue
+            files = ','.join(['%s-header.csv' % group] + [os.path.basename(p) for p in info[3]])
+            if info[0] == 'nodes':
+                lines.append('    --nodes:%s %s \\' % (info[1], files))
+            else:
+                lines.append('    --relationships %s \\' % files)
+        lines.append('    "$@"')
+        path = os.path.join(self.outpath, 'import.sh')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(path, 0755)
+
+    def close(self):
+        """
+        Write the aggregated relations and close the open part files.
+        """
+
+        uniques, sent_ids, order = self.relations
+        if order:
+            self.write_rows('relations', (uniques[k] for k in order))
+            time_log('Wrote %d aggregated relations' % len(order))
+        self.relations = ({}, {}, [])
+        for info in self.groups.values():
+            if info[4] is not None:
+                info[4].close()
+                info[4] = None
+        if self.groups:
+            self.write_manifest()
+
+
+_csv_writers = {}
+
+
+def close_csv_writers():
+    """
+    Close all the open Neo4jCsvWriters.
+    """
+    for writer in _csv_writers.values():
+        writer.close()
+    _csv_writers.clear()
+
+
+atexit.register(close_csv_writers)
+
+
 def create_neo4j_csv(results):
     """
     Create csv's for use by the neo4j import tool. Relies on create_neo4j_ functions
     output and transforms it to suitable format for automatic importing.
+    The files are appended to on every call, so in streaming mode each
+    batch is written as soon as it is processed, while an import.sh script
+    running neo4j-admin import on them is kept up to date. The relations
+    between entities are aggregated across calls and written when the
+    writers are closed, check close_csv_writers.
     Input: 
         - results: dic,
         json-style dictionary. Check create_neo4j_ function output for
@@ -350,118 +858,94 @@ def create_neo4j_csv(results):
         in settings.yaml 
     """
     outpath = settings['out']['csv']['out_path']
-    entities_nodes = None
-    articles_nodes = None
-    relations_edges = None
-    entity_pmc_edges = None
-    other_nodes = []
-    other_edges = []
-    for nodes in results['nodes']:
-        if nodes['type'] == 'Entity':
-            entities_nodes = nodes['values']
-        elif nodes['type'] == 'Article':
-            articles_nodes = nodes['values']
-        else:
-            other_nodes.extend(nodes['values'])
-    for edges in results['edges']:
-        if edges['type'] == 'relation':
-            relations_edges = edges['values']
-        elif edges['type'] == 'mention':
-            entity_pmc_edges = edges['values']
-        elif edges['type'] == 'NEW':
-            other_edges.extend(edges['values'])
-
-    dic_ = {
-        'entities.csv': entities_nodes,
-        'articles.csv': articles_nodes,
-        'other_nodes.csv': other_nodes,
-        'entities_pmc.csv':entity_pmc_edges, 
-        'relations.csv':relations_edges,
-        'other_edges.csv': other_edges
-    }
-
-    dic_fiels = {
-        'entities.csv': ['id:ID', 'label', 'sem_types:string[]'],
-        'articles.csv': ['id:ID', 'title', 'journal','sent_id:string[]'],
-        'other_nodes.csv': ['id:ID'],
-        'entities_pmc.csv':[':START_ID','score:float[]','sent_id:string[]', ':END_ID'], 
-        'relations.csv':[':START_ID','subject_score:float[]','subject_sem_type:string[]',':TYPE','pred_type:string[]', 'object_score:float[]','object_sem_type:string[]','sent_id:string[]','negation:string[]',':END_ID'],
-        'other_edges.csv':[':START_ID', ':TYPE', ':END_ID']
-    }
-
-    for k, toCSV in dic_.iteritems():
-        if toCSV:
-            keys = toCSV[0].keys()
-            out = os.path.join(outpath, k)
-            with open(out, 'wb') as output_file:
-                time_log("Created file %s" % k)
-                dict_writer = csv2.DictWriter(output_file, fieldnames=dic_fiels[k], encoding='utf-8')
-                dict_writer.writeheader()
-                dict_writer.writerows(toCSV)
+    if not(outpath in _csv_writers):
+        _csv_writers[outpath] = Neo4jCsvWriter(outpath, settings['out']['csv'].get('part_size', 1000000))
+    _csv_writers[outpath].write(results)
     time_log('Created all documents needed')
 
 
-
-def fix_on_create_nodes(node):
+def create_node_props(node):
     """
-    Helper function to create the correct cypher string for
-    querying and merging a new node to the graph. This is used
-    when no node is matched and a new one has to be created.
+    Helper function to create the properties to be set when a node is
+    created in the graph. Id is left out, as it is merged upon. Arrays
+    are converted to lists and empty values are skipped.
     Input:
         - node: dic,
         dictionary of a node generated from some create_neo4j_
         function
     Output:
-        - s: string,
-        part of cypher query, responsible handling the creation of anew node
-    """
-    s = ' '
-    # Has at least one other attribute to create than id
-    if len(node.keys())>1:
-        s = 'ON CREATE SET '
-        for key, value in node.iteritems():
-            if (value) and (value != " "):
-                if 'ID' in key.split(':'):
-                    continue
-                elif 'string[]' in key:
-                    field = key.split(':')[0]
-                    string_value = '['
-                    for i in value.split(';'):
-                        string_value += '"' + i + '"' + ','
-                    string_value = string_value[:-1] + ']'
-                    s += ' a.%s = %s,' % (field, string_value)
-                elif 'float[]' in key:
-                    field = key.split(':')[0]
-                    string_value = str([int(i) for i in value.split(';')])
-                    s += ' a.%s = %s,' % (field, string_value)
-                else:
-                    field = key.split(':')[0]
-                    s += ' a.%s = "%s",' % (field, value.replace('"', "'"))
-        s = s[:-1]
-    # No attributes
-    return s
-
-
-def create_merge_query(node, type_):
-    """
-    Creating the whole merge and update cypher query for a node.
+        - props: dic,
+        the properties of the node, keyed by their name in the graph
+    """
+    props = {}
+    for key, value in node.iteritems():
+        if (value) and (value != " "):
+            field = key.split(':')[0]
+            if 'ID' in key.split(':'):
+                continue
+            elif 'string[]' in key:
+                props[field] = split_array(value)
+            elif 'float[]' in key:
+                props[field] = [int(i) for i in split_array(value)]
+            else:
+                props[field] = value
+    return props
+
+
+def run_batches(graph, quer, rows, batch_size=1000, name='rows'):
+    """
+    Function that runs a parameterized UNWIND $rows query over the rows
+    given, in batches of batch_size rows. Each batch is run in its own
+    explicit transaction and its counters are logged.
     Input:
-        - node: dic,
-        dictionary of a node containing the attributes of the
-        node
-        - type_: str,
-        type of the node to be merged
-    Output:
+        - graph: py2neo.Graph,
+        object representing the graph in neo4j. Using py2neo.
         - quer: str,
-        the complete cypher query ready to be run
+        cypher query starting with UNWIND $rows AS row
+        - rows: list,
+        list of dics with the parameters of each element
+        - batch_size: int,
+        number of rows sent in each transaction
+        - name: str,
+        name of the elements. For printing purposes only
+    Output:
+        - totals: dic,
+        the counters of all the batches summed up
     """
-    quer = """
-    MERGE (a:%s {id:"%s"})
-    %s""" % (type_, node["id:ID"], fix_on_create_nodes(node))
-    return quer
+    totals = {'nodes_created': 0, 'relationships_created': 0, 'properties_set': 0}
+    N = len(rows)
+    for i in xrange(0, N, batch_size):
+        batch = rows[i:i+batch_size]
+        tx = graph.begin()
+        cursor = tx.run(quer, rows=batch)
+        tx.commit()
+        stats = cursor.stats()
+        for key in totals:
+            totals[key] += stats.get(key, 0)
+        time_log('Batch of %d %s (%d/%d): %d nodes created, %d relationships created, %d properties set' %
+                 (len(batch), name, min(i + batch_size, N), N, stats.get('nodes_created', 0),
+                  stats.get('relationships_created', 0), stats.get('properties_set', 0)))
+    return totals
 
 
-def populate_nodes(graph, nodes, type_):
+def group_by_type(edges):
+    """
+    Group edges according to their :TYPE field, as relationship types
+    can't be passed as query parameters.
+    Input:
+        - edges: list,
+        list of dics of edges containing a :TYPE field
+    Output:
+        - groups: dic,
+        dictionary of edge type to the list of the edges of that type
+    """
+    groups = {}
+    for edge in edges:
+        groups.setdefault(edge[':TYPE'], []).append(edge)
+    return groups
+
+
+def populate_nodes(graph, nodes, type_, batch_size=1000):
     """
     Function that actually calls the cypher query and populates the graph
     with nodes of type_, merging on already existing nodes on their id_.
@@ -472,129 +956,105 @@ def populate_nodes(graph, nodes, type_):
         list of dics containing the attributes of each node
         - type_: str,
         type of the node to be merged
+        - batch_size: int,
+        number of nodes sent in each transaction
     Output: None, populates the db.
     """
-    c = 0
-    total_rel = 0
     time_log('~~~~~~  Will create nodes of type: %s  ~~~~~~' % type_)
-    for ent in nodes:
-        c += 1
-        quer = create_merge_query(ent, type_)
-        f = graph.run(quer)
-        total_rel += f.stats()['nodes_created']
-        if c % 1000 == 0 and c > 999:
-            time_log("Process: %d -- %0.2f %%" % (c, 100*c/float(len(nodes))))
-    time_log('#%s : %d' % (type_, c))
-    time_log('Finally added %d new nodes!' % total_rel) 
+    quer = """
+    UNWIND $rows AS row
+    MERGE (a:`%s` {id: row.id})
+    ON CREATE SET a += row.props
+    """ % type_
+    rows = [{'id': node['id:ID'], 'props': create_node_props(node)} for node in nodes]
+    totals = run_batches(graph, quer, rows, batch_size, type_)
+    time_log('#%s : %d' % (type_, len(rows)))
+    time_log('Finally added %d new nodes!' % totals['nodes_created'])
 
 
-def populate_relation_edges(graph, relations_edges):
+def populate_relation_edges(graph, relations_edges, batch_size=1000):
     """
     Function to create/merge the relation edges between existing entities.
+    A single statement per batch merges the relationship and appends only
+    the sentences not already in it, along with the matching elements of
+    the other arrays.
     Input:
         - graph: py2neo.Graph,
         object representing the graph in neo4j. Using py2neo.
         - relations_edges: list,
         list of dics containing the attributes of each relation
+        - batch_size: int,
+        number of relations sent in each transaction
     Output: None, populates the db.
     """
-    c = 0
     total_rel = 0
-    for edge in relations_edges:
-        c +=1  
+    for type_, edges in group_by_type(relations_edges).iteritems():
         quer = """
-        Match (a:Entity {id:"%s"}), (b:Entity {id:"%s"})
-        MATCH (a)-[r:%s]->(b)
-        WHERE "%s" in r.sent_id
-        Return r;
-        """ % (edge[':START_ID'], edge[':END_ID'], edge[':TYPE'], edge['sent_id:string[]'].split(';')[0])
-        print quer
-        f = graph.run(quer)
-        if len(f.data()) == 0:
-            subj_s = '['
-            for i in edge['subject_sem_type:string[]'].split(';'):
-                subj_s += '"' + i + '"' + ','
-            subj_s = subj_s[:-1] + ']'
-            obj_s = '['
-            for i in edge['object_sem_type:string[]'].split(';'):
-                obj_s += '"' + i + '"' + ','
-            obj_s = obj_s[:-1] + ']'
-            sent_s = '['
-            for i in edge['sent_id:string[]'].split(';'):
-                sent_s += '"' + i + '"' + ','
-            sent_s = sent_s[:-1] + ']'
-            neg_s = '['
-            for i in edge['negation:string[]'].split(';'):
-                neg_s += '"' + i + '"' + ','
-            neg_s = neg_s[:-1] + ']'
-            quer = """
-            Match (a:Entity {id:"%s"}), (b:Entity {id:"%s"})
-            MERGE (a)-[r:%s]->(b)
-            ON MATCH SET r.subject_score = r.subject_score + %s, r.subject_sem_type = r.subject_sem_type + %s,
-            r.object_score = r.object_score + %s, r.object_sem_type = r.object_sem_type + %s,
-            r.sent_id = r.sent_id + %s, r.negation = r.negation + %s
-            ON CREATE SET r.subject_score = %s, r.subject_sem_type =  %s,
-            r.object_score =  %s, r.object_sem_type =  %s,
-            r.sent_id =  %s, r.negation =  %s
-            """ % (edge[':START_ID'], edge[':END_ID'], edge[':TYPE'], 
-                   str([int(i) for i in edge['subject_score:float[]'].split(';')]), subj_s, 
-                   str([int(i) for i in edge['object_score:float[]'].split(';')]), obj_s,
-                 sent_s, neg_s, str([int(i) for i in edge['subject_score:float[]'].split(';')]), subj_s, 
-                   str([int(i) for i in edge['object_score:float[]'].split(';')]), obj_s,
-                 sent_s, neg_s)
-            print quer
-            print '~'*50
-            f = graph.run(quer)
-            total_rel += f.stats()['relationships_created']
-        if c % 1000 == 0 and c > 999:
-            time_log('Process: %d -- %0.2f %%' % (c, 100*c/float(len(relations_edges))))
-    time_log('#Relations :%d' % c)
+        UNWIND $rows AS row
+        MATCH (a:Entity {id: row.start}), (b:Entity {id: row.end})
+        MERGE (a)-[r:`%s`]->(b)
+        WITH r, row, [i IN range(0, size(row.sent_id) - 1)
+                      WHERE NOT row.sent_id[i] IN coalesce(r.sent_id, [])] AS new
+        WHERE size(new) > 0
+        SET r.subject_score = coalesce(r.subject_score, []) + [i IN new | row.subject_score[i]],
+        r.subject_sem_type = coalesce(r.subject_sem_type, []) + [i IN new | row.subject_sem_type[i]],
+        r.object_score = coalesce(r.object_score, []) + [i IN new | row.object_score[i]],
+        r.object_sem_type = coalesce(r.object_sem_type, []) + [i IN new | row.object_sem_type[i]],
+        r.negation = coalesce(r.negation, []) + [i IN new | row.negation[i]],
+        r.sent_id = coalesce(r.sent_id, []) + [i IN new | row.sent_id[i]]
+        """ % type_
+        rows = []
+        for edge in edges:
+            rows.append({'start': edge[':START_ID'],
+                         'end': edge[':END_ID'],
+                         'subject_score': [int(i) for i in split_array(edge['subject_score:float[]'])],
+                         'subject_sem_type': split_array(edge['subject_sem_type:string[]']),
+                         'object_score': [int(i) for i in split_array(edge['object_score:float[]'])],
+                         'object_sem_type': split_array(edge['object_sem_type:string[]']),
+                         'sent_id': split_array(edge['sent_id:string[]']),
+                         'negation': split_array(edge['negation:string[]'])})
+        totals = run_batches(graph, quer, rows, batch_size, type_)
+        total_rel += totals['relationships_created']
+    time_log('#Relations :%d' % len(relations_edges))
     time_log('Finally added %d new relations!' % total_rel)
 
-def populate_mentioned_edges(graph, entity_pmc_edges):
+
+def populate_mentioned_edges(graph, entity_pmc_edges, batch_size=1000):
     """
-    Function to create/merge the relation edges between existing entities.
+    Function to create/merge the mentioned-in edges between existing
+    entities and articles. Only the sentences not already in the
+    relationship are appended, along with their scores.
     Input:
         - graph: py2neo.Graph,
         object representing the graph in neo4j. Using py2neo.
         - entity_pmc_edges: list,
         list of dics containing the attributes of each relation
+        - batch_size: int,
+        number of mentions sent in each transaction
     Output: None, populates the db.
     """
-
-    c = 0
-    total_rel = 0
+    quer = """
+    UNWIND $rows AS row
+    MATCH (a:Entity {id: row.start}), (b:Article {id: row.end})
+    MERGE (a)-[r:MENTIONED_IN]->(b)
+    WITH r, row, [i IN range(0, size(row.sent_id) - 1)
+                  WHERE NOT row.sent_id[i] IN coalesce(r.sent_id, [])] AS new
+    WHERE size(new) > 0
+    SET r.score = coalesce(r.score, []) + [i IN new | row.score[i]],
+    r.sent_id = coalesce(r.sent_id, []) + [i IN new | row.sent_id[i]]
+    """
+    rows = []
     for edge in entity_pmc_edges:
-        c += 1
-        quer = """
-        Match (a:Entity {id:"%s"}), (b:Article {id:"%s"})
-        MATCH (a)-[r:MENTIONED_IN]->(b)
-        WHERE "%s" in r.sent_id
-        Return r;
-        """ % (edge[':START_ID'], edge[':END_ID'],  edge['sent_id:string[]'])
-        f = graph.run(quer)
-        if len(f.data()) == 0:
-            sent_s = '['
-            for i in edge['sent_id:string[]'].split(';'):
-                sent_s += '"' + i + '"' + ','
-            sent_s = sent_s[:-1] + ']'
-            quer = """
-            Match (a:Entity {id:"%s"}), (b:Article {id:"%s"})
-            MERGE (a)-[r:MENTIONED_IN]->(b)
-            ON MATCH SET r.score = r.score + %s, r.sent_id = r.sent_id + %s
-            ON CREATE SET r.score = %s, r.sent_id = %s
-            """ % (edge[':START_ID'], edge[':END_ID'], 
-                   str([int(i) for i in edge['score:float[]'].split(';')]), sent_s,
-                   str([int(i) for i in edge['score:float[]'].split(';')]), sent_s)
-            f = graph.run(quer)
-            total_rel += f.stats()['relationships_created']
-        if c % 1000 == 0 and c>999:
-            time_log("Process: %d -- %0.2f %%" % (c, 100*c/float(len(entity_pmc_edges))))
-    time_log('#Mentions: %d' % c)
-    time_log('Finally added %d new mentions!' % total_rel)
-
-
-def populate_new_edges(graph, new_edges):
+        rows.append({'start': edge[':START_ID'],
+                     'end': edge[':END_ID'],
+                     'score': [int(i) for i in split_array(edge['score:float[]'])],
+                     'sent_id': split_array(edge['sent_id:string[]'])})
+    totals = run_batches(graph, quer, rows, batch_size, 'mentions')
+    time_log('#Mentions: %d' % len(rows))
+    time_log('Finally added %d new mentions!' % totals['relationships_created'])
+
+
+def populate_new_edges(graph, new_edges, batch_size=1000):
     """
     Function to create/merge an unknwon type of edge.
     Input:
@@ -602,76 +1062,217 @@ def populate_new_edges(graph, new_edges):
         object representing the graph in neo4j. Using py2neo.
         - new_edges: list,
         list of dics containing the attributes of each relation
+        - batch_size: int,
+        number of edges sent in each transaction
     Output: None, populates the db.
     """
 
-    c = 0
     total_rel = 0
     # field containing the type of the node for the subject
     sub_type = settings['load']['edges']['sub_type']
     # field containing the type of the node for the object
     obj_type = settings['load']['edges']['obj_type']
 
-    for edge in new_edges:
-        c += 1
+    for type_, edges in group_by_type(new_edges).iteritems():
         quer = """
-        MATCH (a:%s {id:"%s"}), (b:%s {id:"%s"})
-        MERGE (a)-[r:%s]->(b)
-        """ % (sub_type, edge[':START_ID'], obj_type, edge[':END_ID'], edge[':TYPE'],)
-        f = graph.run(quer)
-        total_rel += f.stats()['relationships_created']
-        if c % 1000 == 0 and c > 999:
-            time_log("Process: %d -- %0.2f %%" % (c, 100*c/float(len(new_edges))))
-    time_log('#Edges: %d' % c)
+        UNWIND $rows AS row
+        MATCH (a:`%s` {id: row.start}), (b:`%s` {id: row.end})
+        MERGE (a)-[r:`%s`]->(b)
+        """ % (sub_type, obj_type, type_)
+        rows = [{'start': edge[':START_ID'], 'end': edge[':END_ID']} for edge in edges]
+        totals = run_batches(graph, quer, rows, batch_size, type_)
+        total_rel += totals['relationships_created']
+    time_log('#Edges: %d' % len(new_edges))
     time_log('Finally added %d new edges!' % total_rel)
 
 
 
+def plan_operators(plan):
+    """
+    Helper function to list the operators of a query plan, as returned by
+    the EXPLAIN of a query, walking the plan tree.
+    """
+    if plan is None:
+        return []
+    if isinstance(plan, dict):
+        operator = plan.get('operator_type', plan.get('operatorType'))
+        children = plan.get('children', [])
+    else:
+        operator = getattr(plan, 'operator_type', None)
+        children = getattr(plan, 'children', [])
+    operators = [operator] if operator else []
+    for child in children:
+        operators.extend(plan_operators(child))
+    return operators
+
+
+def report_index_usage(graph, label):
+    """
+    Log whether merging on the id of label nodes is planned as an index
+    seek or as a scan of all the nodes of label.
+    Input:
+        - graph: py2neo.Graph,
+        object representing the graph in neo4j. Using py2neo.
+        - label: str,
+        the label of the nodes
+    """
+    cursor = graph.run('EXPLAIN MERGE (a:`%s` {id: $id})' % label, id='')
+    if not hasattr(cursor, 'plan'):
+        return
+    operators = plan_operators(cursor.plan())
+    if any('Index' in op for op in operators):
+        time_log('Lookups of %s nodes by id use the index' % label)
+    else:
+        time_log('Lookups of %s nodes by id do NOT use an index: %s' % (label, ', '.join(operators)))
+
+
+# Description of a uniqueness constraint, as listed by db.constraints(),
+# e.g. CONSTRAINT ON ( entity:Entity ) ASSERT entity.id IS UNIQUE
+UNIQUE_CONSTRAINT = re.compile(r'^CONSTRAINT ON \( *(`[^`]+`|\w+):(`[^`]+`|\w+) *\) '
+                               r'ASSERT (`[^`]+`|\w+)\.(`[^`]+`|\w+) IS UNIQUE$')
+
+
+def unique_id_labels(descriptions):
+    """
+    Helper function to find the labels that already have a uniqueness
+    constraint on the id property.
+    Input:
+        - descriptions: iterable,
+        the descriptions of the constraints of the db
+    Output:
+        - labels: set,
+        the labels with such a constraint
+    """
+    labels = set()
+    for description in descriptions:
+        match = UNIQUE_CONSTRAINT.match(description.strip())
+        if match:
+            var, label, var_, prop = [name.strip('`') for name in match.groups()]
+            if var == var_ and prop == 'id':
+                labels.add(label)
+    return labels
+
+
+def ensure_schema(graph, labels, timeout=300):
+    """
+    Function to create the uniqueness constraints on the id of the nodes of
+    each label, so that the MERGE and MATCH queries of the populate_
+    functions are index seeks instead of label scans. Waits for the indexes
+    backing the constraints to come online and reports their usage.
+    Input:
+        - graph: py2neo.Graph,
+        object representing the graph in neo4j. Using py2neo.
+        - labels: list,
+        the labels of the nodes to be merged
+        - timeout: int,
+        seconds to wait for the indexes to come online
+    Output: None, creates the constraints in the db.
+    """
+    existing = unique_id_labels(record['description'] for record in graph.run('CALL db.constraints()'))
+    for label in labels:
+        if label in existing:
+            continue
+        try:
+            graph.run('CREATE CONSTRAINT ON (a:`%s`) ASSERT a.id IS UNIQUE' % label)
+            time_log('Created uniqueness constraint on %s.id' % label)
+        except Exception, e:
+            time_log("Couldn't create uniqueness constraint on %s.id! Duplicate ids?" % label)
+            time_log(e)
+    graph.run('CALL db.awaitIndexes(%d)' % timeout)
+    for record in graph.run('CALL db.indexes()'):
+        time_log('Index %s: %s' % (record['description'], record['state']))
+    for label in labels:
+        report_index_usage(graph, label)
+
+
 def update_neo4j(results):
     
     """
     Function to create/update a neo4j database according to the nodeg and edges
     generated by the create_neo4j_ functions. Change settings.yaml values in
-    the neo4j group of variables to match your needs.
+    the neo4j group of variables to match your needs. On the first call the
+    uniqueness constraints on the ids of the nodes are created, check
+    ensure_schema.
     Input:
         - results: 
         json-style dictionary. Check create_neo4j_ functions output for
         details
     Output: None, creates/merges the nodes to the wanted database
     """
-    host = settings['neo4j']['host']
-    port = settings['neo4j']['port']
-    user = settings['neo4j']['user']
-    password = settings['neo4j']['password']
+    batch_size = settings['neo4j']['batch_size']
     try:
-        graph = py2neo.Graph(host=host, port=port, user=user, password=password)
+        graph = get_graph()
     except Exception, e:
-        #time_log(e)
-        #time_log("Couldn't connect to db! Check settings!")
-        exit(2)
-    graph_new = py2neo.Graph()
+        time_log(e)
+        time_log("Couldn't connect to db! Check settings!")
+        raise
+    if not('neo4j_schema' in _connections):
+        labels = ['Entity', 'Article']
+        for label in [settings['load']['edges']['sub_type'], settings['load']['edges']['obj_type']]:
+            if not(label in labels):
+                labels.append(label)
+        ensure_schema(graph, labels, settings['neo4j'].get('index_timeout', 300))
+        _connections['neo4j_schema'] = True
     for nodes in results['nodes']:
-        populate_nodes(graph, nodes['values'], nodes['type'])
+        populate_nodes(graph, nodes['values'], nodes['type'], batch_size)
     for edges in results['edges']:
         if edges['type'] == 'relation':
             time_log('~~~~~~  Will create Relations Between Entities ~~~~~~')
-            populate_relation_edges(graph, edges['values'])
+            populate_relation_edges(graph, edges['values'], batch_size)
         elif edges['type'] == 'mention':
             time_log('~~~~~~  Will create Mentioned In  ~~~~~~')
-            populate_mentioned_edges(graph, edges['values'])
+            populate_mentioned_edges(graph, edges['values'], batch_size)
         elif edges['type'] == 'NEW':
             time_log('~~~~~~  Will create new-type of edges~~~~~~')
-            populate_new_edges(graph, edges['values'])
+            populate_new_edges(graph, edges['values'], batch_size)
         else:
             time_log('Specific node type not handled! You have to update the code!')
             raise NotImplementedError 
 
 
+def mongo_bulk_write(collection, ops, ordered):
+    """
+    Helper function to send a batch of write operations to mongodb. Upserts
+    racing with others on the same new id fail on the unique index, so
+    these are sent once more, as they will then match the existing
+    document.
+    Input:
+        - collection: pymongo.collection.Collection,
+        the collection to write to
+        - ops: list,
+        list of pymongo write operations
+        - ordered: bool,
+        whether to stop at the first failing operation
+    Output:
+        - (inserted, updated): tuple,
+        number of upserted and modified documents
+    """
+    from pymongo.errors import BulkWriteError
+    try:
+        res = collection.bulk_write(ops, ordered=ordered)
+        return res.upserted_count, res.modified_count
+    except BulkWriteError, e:
+        details = e.details
+        retry = [ops[err['index']] for err in details['writeErrors'] if err['code'] == 11000]
+        if len(retry) < len(details['writeErrors']):
+            raise
+        if ordered:
+            # Operations after the failing one were not sent either
+            retry.extend(ops[details['writeErrors'][-1]['index'] + 1:])
+        res = collection.bulk_write(retry, ordered=ordered)
+        return (details['nUpserted'] + res.upserted_count,
+                details['nModified'] + res.modified_count)
+
+
 def update_mongo(json_):
     """
     Helper function to save the sentences found in the enriched articles in
     mongodb. Connecting to a collection according to settings and then
-    creating/updating the articles with the sentences found in them.
+    creating/updating the articles with the sentences found in them. The
+    sent_ids already saved for the articles of each batch are read with a
+    single query, and each article is then upserted with one operation
+    pushing only its new sentences, so re-extracted sentences are not
+    added twice. The collection gets a unique index on id.
     Input:
         - json_: dic,
         json-style dictionary generated from the semrep extractor in the
@@ -683,33 +1284,44 @@ def update_mongo(json_):
         None, just populates the database
 
     """
-    uri = settings['mongo']['uri']
-    db_name = settings['mongo']['db']
-    collection_name = settings['mongo']['collection']
-    client = pymongo.MongoClient(uri)
-    db = client[db_name]
-    collection = db[collection_name]
+    from pymongo import UpdateOne
+    collection = get_mongo_collection()
+    if not('mongo_index' in _connections):
+        collection.create_index('id', unique=True)
+        _connections['mongo_index'] = True
+    batch_size = settings['mongo'].get('batch_size', 1000)
+    ordered = str(settings['mongo'].get('ordered')) == 'True'
+    docs = json_[settings['out']['json']['json_doc_field']]
+    # Sentences of each article by sent_id, merging articles that appear
+    # twice and keeping the first sentence of each sent_id
+    sents = {}
+    order = []
+    for doc in docs:
+        if not(doc['id'] in sents):
+            sents[doc['id']] = {}
+            order.append(doc['id'])
+        for sent in doc['sents']:
+            sents[doc['id']].setdefault(sent['sent_id'], {'sent_id': sent['sent_id'],
+                                                          'text': sent['sent_text']})
     new = 0
     upd = 0
-    docs = json_[settings['out']['json']['json_doc_field']]
-    for i, doc in enumerate(docs):
-        cursor = collection.find({'id': doc['id']})
-        sents = [{'sent_id': sent['sent_id'], 'text': sent['sent_text']} for sent in doc['sents']]
-        if cursor.count() == 0:
-            collection.insert_one({'id': doc['id'], 'sentences': sents})
-            new += 1
-        else:
-            for mongo_doc in cursor:
-                cur_sent = mongo_doc['sentences']
-                cur_ids = [s['sent_id'] for s in cur_sent]
-                new_sent = [s for s in sents if not(s['sent_id'] in cur_ids)]
-                if new_sent:
-                    cur_sent.extend(new_sent)
-                    mongo_doc['sentences'] = cur_sent
-                    collection.replace_one({'id': doc['id']}, mongo_doc)
-                    upd += 1
-        if i % 100 == 0 and i > 99:
-            time_log("Process: %d -- %0.2f %%" % (i, 100*i/float(len(docs))))
+    for i in xrange(0, len(order), batch_size):
+        ids = order[i:i+batch_size]
+        known = {}
+        for mongo_doc in collection.find({'id': {'$in': ids}}, {'id': 1, 'sentences.sent_id': 1}):
+            known[mongo_doc['id']] = set(sent['sent_id'] for sent in mongo_doc.get('sentences', []))
+        ops = []
+        for id_ in ids:
+            new_sents = [sent for sent_id, sent in sorted(sents[id_].iteritems())
+                         if not(sent_id in known.get(id_, ()))]
+            if new_sents or not(id_ in known):
+                ops.append(UpdateOne({'id': id_}, {'$push': {'sentences': {'$each': new_sents}}},
+                                     upsert=True))
+        if ops:
+            inserted, updated = mongo_bulk_write(collection, ops, ordered)
+            new += inserted
+            upd += updated
+        time_log("Process: %d -- %0.2f %%" % (i + len(ids), 100*(i + len(ids))/float(len(order))))
     time_log('Finally updated %d -- inserted %d documents!' % (upd, new))
 
 
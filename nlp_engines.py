@@ -0,0 +1,486 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Long-lived wrappers around the external NLP binaries. Instead of opening
+# a new shell for every document, the processes are started once and fed
+# through their stdin, so the start-up cost (e.g. loading the lexicon) is
+# paid only once per process. Where the binary can't be kept running, the
+# inputs of many documents are batched into each call instead.
+
+import os
+import atexit
+import subprocess
+import threading
+import Queue
+from utilities import time_log
+
+
+class SemRepProcess(object):
+    """
+    A single SemRep process that stays alive between calls. Text is written
+    to its stdin followed by a sentinel sentence and the -F output is read
+    back until the sentinel shows up, so each call knows where its own
+    output ends.
+    """
+
+    # Text of the sentinel sentence. It must not be something SemRep could
+    # map to a concept or split into more than one sentence.
+    sentinel = 'zzmedknowsentinelzz'
+
+    def __init__(self, semrep_dir, cmd):
+        """
+        Initialization of the class.
+        Input:
+            - semrep_dir: str,
+            directory where the SemRep binary is located
+            - cmd: list,
+            the binary and its flags, e.g. ['./semrep.v1.7', '-F']
+        """
+
+        self.semrep_dir = semrep_dir
+        self.cmd = cmd
+        self.proc = None
+        # stderr of the process, opened once and reused across restarts
+        self.devnull = None
+
+    def start(self):
+        """
+        Start the SemRep process if it is not already running.
+        """
+
+        if self.proc is None or self.proc.poll() is not None:
+            if self.devnull is None:
+                self.devnull = open(os.devnull, 'w')
+            self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=self.devnull,
+                                         cwd=self.semrep_dir,
+                                         bufsize=1)
+
+    def is_sentinel(self, line):
+        """
+        Check whether an output line is the text line of the sentinel.
+        """
+
+        elements = line.split('|')
+        return len(elements) > 6 and elements[5] == 'text' and self.sentinel in elements[6]
+
+    def feed(self, proc, data):
+        """
+        Write data to the stdin of SemRep. Runs in its own thread, so that
+        the output pipe is read at the same time and a long text can't
+        fill both pipes and block the two processes.
+        """
+
+        try:
+            proc.stdin.write(data)
+            proc.stdin.flush()
+        except IOError:
+            # The process died, which the reader notices at the end of
+            # its output
+            pass
+
+    def lines(self, text):
+        """
+        Feed a piece of text to SemRep and yield the output lines as they
+        are produced, up to (and excluding) the sentinel sentence.
+        Input:
+            - text: str,
+            a piece of text, already cleaned with clean_text
+        Output:
+            - generator of the output lines
+        """
+
+        self.start()
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        writer = threading.Thread(target=self.feed,
+                                  args=(self.proc, text + '\n\n' + self.sentinel + '.\n\n'))
+        writer.daemon = True
+        writer.start()
+        # Lines of the previous sentinel may still be in the pipe, so skip
+        # anything before the first sentence of this text
+        started = False
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                # The process died in the middle of our text
+                self.proc = None
+                raise IOError('SemRep process exited unexpectedly!')
+            if self.is_sentinel(line):
+                writer.join()
+                break
+            if not started:
+                elements = line.split('|')
+                if not(len(elements) > 5 and elements[5] == 'text'):
+                    continue
+                started = True
+            yield line
+
+    def close(self):
+        """
+        Terminate the SemRep process.
+        """
+
+        if self.proc is not None and self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+                self.proc.terminate()
+                self.proc.wait()
+            except (OSError, IOError):
+                pass
+        self.proc = None
+        if self.devnull is not None:
+            self.devnull.close()
+            self.devnull = None
+
+
+class SemRepPool(object):
+    """
+    Pool of long-lived SemRep processes. Each call borrows an idle process,
+    streams its output lines and gives it back, so the pool can be shared
+    between threads.
+    """
+
+    def __init__(self, semrep_dir, cmd, size=1):
+        """
+        Initialization of the class. The processes are started lazily, on
+        their first use.
+        Input:
+            - semrep_dir: str,
+            directory where the SemRep binary is located
+            - cmd: list,
+            the binary and its flags
+            - size: int,
+            number of SemRep processes to keep alive
+        """
+
+        self.size = max(int(size), 1)
+        self.workers = [SemRepProcess(semrep_dir, cmd) for i in xrange(self.size)]
+        self.idle = Queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        time_log('Created a pool of %d SemRep processes' % self.size)
+
+    def lines(self, text):
+        """
+        Yield the SemRep -F output lines for text using an idle process of
+        the pool. Blocks while all processes are busy.
+        """
+
+        worker = self.idle.get()
+        try:
+            for line in worker.lines(text):
+                yield line
+        except (IOError, GeneratorExit):
+            # Do not hand a half-read process to the next caller
+            worker.close()
+            raise
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        """
+        Terminate all the processes of the pool.
+        """
+
+        with self.lock:
+            for worker in self.workers:
+                worker.close()
+
+
+class MetaMapEngine(object):
+    """
+    MetaMap client that is created once per process and submits the
+    sentences of many documents together. pymetamap starts a new MetaMap
+    process for every call, so sentences are sent in batches of batch_size,
+    each with a global id, and that cost is paid once per batch instead of
+    once per document.
+    """
+
+    def __init__(self, metamap_path, batch_size=1000):
+        """
+        Initialization of the class.
+        Input:
+            - metamap_path: str,
+            path to the MetaMap binary
+            - batch_size: int,
+            number of sentences submitted in each MetaMap call
+        """
+
+        from pymetamap import MetaMap
+        self.mm = MetaMap.get_instance(metamap_path)
+        self.batch_size = max(int(batch_size), 1)
+        self.pid = os.getpid()
+
+    def extract_sentences(self, sents):
+        """
+        Extract the concepts of a list of sentences.
+        Input:
+            - sents: list,
+            the sentences, as strings
+        Output:
+            - concepts: list,
+            for each sentence, the list of its pymetamap concepts that have
+            a cui
+        """
+
+        grouped = [[] for sent in sents]
+        for i in xrange(0, len(sents), self.batch_size):
+            batch = sents[i:i+self.batch_size]
+            concepts, errors = self.mm.extract_concepts(batch, range(i, i + len(batch)))
+            if errors:
+                time_log('Errors with extracting concepts!')
+                time_log(errors)
+            # The index of each concept is the global id of its sentence
+            for concept in concepts:
+                if hasattr(concept, 'cui'):
+                    grouped[int(concept.index)].append(concept)
+        return grouped
+
+    def extract_texts(self, texts):
+        """
+        Split texts into sentences and extract their concepts, submitting
+        the sentences of all the texts together.
+        Input:
+            - texts: list,
+            the cleaned texts of the documents
+        Output:
+            - results: list,
+            for each text, a dictionary with fields sents and sent_text, as
+            returned by metamap_wrapper
+        """
+
+        from nltk.tokenize import sent_tokenize
+        return self.extract_tokenized([(text, sent_tokenize(text)) for text in texts])
+
+    def extract_tokenized(self, docs):
+        """
+        Same as extract_texts, for texts already split into sentences.
+        Input:
+            - docs: list,
+            list of (text, sentences) tuples
+        Output:
+            - results: list,
+            the results of each text
+        """
+
+        grouped = self.extract_sentences([sent for text, sents in docs for sent in sents])
+        results = []
+        c = 0
+        for text, sents in docs:
+            sentences = []
+            for i in xrange(len(sents)):
+                tmp = {'sent_id': i+1, 'entities': [], 'relations': []}
+                for w_conc in grouped[c]:
+                    tmp['entities'].append({'label': w_conc.preferred_name, 'cui': w_conc.cui,
+                                            'sem_types': w_conc.semtypes, 'score': w_conc.score})
+                sentences.append(tmp)
+                c += 1
+            results.append({'sents': sentences, 'sent_text': text})
+        return results
+
+
+_metamap_engines = {}
+
+
+def get_metamap_engine(metamap_path, batch_size=1000):
+    """
+    Return the MetaMapEngine of the current process for the given binary,
+    creating it on first use.
+    Input:
+        - metamap_path: str,
+        path to the MetaMap binary
+        - batch_size: int,
+        number of sentences submitted in each MetaMap call
+    Output:
+        - engine: MetaMapEngine,
+        the engine to use in this process
+    """
+
+    engine = _metamap_engines.get(metamap_path)
+    if engine is None or engine.pid != os.getpid():
+        engine = MetaMapEngine(metamap_path, batch_size)
+        _metamap_engines[metamap_path] = engine
+    return engine
+
+
+class ReVerbEngine(object):
+    """
+    Batch client of ReVerb. Each call starts a single JVM and streams all
+    the given sentences through it, one per line, reading the extractions
+    back while the sentences are still being written, so that the JVM
+    start-up is paid once per batch and memory stays flat regardless of
+    the number of sentences.
+    """
+
+    def __init__(self, reverb_dir, cmd, batch_size=100000):
+        """
+        Initialization of the class.
+        Input:
+            - reverb_dir: str,
+            directory where the ReVerb binary is located
+            - cmd: list,
+            the binary and its flags, e.g. ['./reverb', '-q']
+            - batch_size: int,
+            number of sentences streamed through each JVM
+        """
+
+        self.reverb_dir = reverb_dir
+        self.cmd = cmd
+        self.batch_size = max(int(batch_size), 1)
+        self.pid = os.getpid()
+
+    def feed(self, proc, lines, errors):
+        """
+        Write the lines to the stdin of ReVerb. Runs in its own thread, so
+        that the output pipe is read at the same time.
+        """
+
+        try:
+            for line in lines:
+                proc.stdin.write(line + '\n')
+        except IOError, e:
+            errors.append(e)
+        finally:
+            proc.stdin.close()
+
+    def extract_batch(self, sents):
+        """
+        Run a single ReVerb JVM on a batch of sentences, one per line.
+        Empty sentences are not fed, as ReVerb doesn't count empty lines,
+        and each extraction is checked against the sentence it is mapped
+        back to, so that ReVerb splitting a line into more sentences
+        raises an IOError instead of shifting the rest of the batch.
+        Input:
+            - sents: list,
+            the sentences, as strings
+        Output:
+            - relations: list,
+            for each sentence, the list of its extractions as dictionaries
+            with fields arg1, rel, arg2 and confidence
+        """
+
+        grouped = [[] for sent in sents]
+        # The non-empty sentences, with whitespace collapsed, and their
+        # position in sents
+        lines = []
+        positions = []
+        for i, sent in enumerate(sents):
+            if isinstance(sent, unicode):
+                sent = sent.encode('utf-8')
+            line = ' '.join(sent.split())
+            if line:
+                lines.append(line)
+                positions.append(i)
+        if not lines:
+            return grouped
+        misplaced = 0
+        # The child keeps its own copy of the devnull descriptor
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=devnull, cwd=self.reverb_dir)
+        errors = []
+        writer = threading.Thread(target=self.feed, args=(proc, lines, errors))
+        writer.daemon = True
+        writer.start()
+        for line in proc.stdout:
+            # Tab-separated fields: source, sentence number (1-based), arg1,
+            # rel, arg2, six token offsets, confidence, sentence, ...
+            elements = line.rstrip('\n').split('\t')
+            if len(elements) < 12:
+                continue
+            try:
+                ind = int(elements[1]) - 1
+                confidence = float(elements[11])
+            except ValueError:
+                continue
+            # The sentence of the extraction, as tokenized by ReVerb, must
+            # be the line it is numbered after
+            if not(0 <= ind < len(lines)) or (len(elements) > 12 and
+                                              ''.join(elements[12].split()) != ''.join(lines[ind].split())):
+                misplaced += 1
+                continue
+            grouped[positions[ind]].append({'arg1': elements[2], 'rel': elements[3],
+                                            'arg2': elements[4], 'confidence': confidence})
+        writer.join()
+        proc.stdout.close()
+        if proc.wait() != 0 or errors:
+            raise IOError('ReVerb exited with code %s!' % proc.returncode)
+        if misplaced:
+            raise IOError('%d ReVerb extractions did not match the sentences of their line numbers!'
+                          % misplaced)
+        return grouped
+
+    def extract_sentences(self, sents):
+        """
+        Extract the relations of a list of sentences, in batches of
+        batch_size sentences. Check extract_batch.
+        """
+
+        grouped = []
+        for i in xrange(0, len(sents), self.batch_size):
+            grouped.extend(self.extract_batch(sents[i:i+self.batch_size]))
+        return grouped
+
+
+_reverb_engines = {}
+
+
+def get_reverb_engine(reverb_dir, cmd, batch_size=100000):
+    """
+    Return the ReVerbEngine of the current process for the given binary,
+    creating it on first use. Check get_semrep_pool for the arguments.
+    """
+
+    key = (reverb_dir, tuple(cmd))
+    engine = _reverb_engines.get(key)
+    if engine is None or engine.pid != os.getpid():
+        engine = ReVerbEngine(reverb_dir, cmd, batch_size)
+        _reverb_engines[key] = engine
+    return engine
+
+
+_pools = {}
+
+
+def get_semrep_pool(semrep_dir, cmd, size=1):
+    """
+    Return the SemRep pool of the current process for the given binary,
+    creating it on first use. Pools are never shared across a fork, as
+    the pipes of the parent cannot be used by the children.
+    Input:
+        - semrep_dir: str,
+        directory where the SemRep binary is located
+        - cmd: list,
+        the binary and its flags
+        - size: int,
+        number of SemRep processes to keep alive
+    Output:
+        - pool: SemRepPool,
+        the pool to use in this process
+    """
+
+    key = (semrep_dir, tuple(cmd))
+    pool = _pools.get(key)
+    if pool is None or pool.pid != os.getpid():
+        pool = SemRepPool(semrep_dir, cmd, size)
+        _pools[key] = pool
+    return pool
+
+
+def close_pools():
+    """
+    Terminate all the pools started by this process.
+    """
+
+    for pool in _pools.values():
+        if pool.pid == os.getpid():
+            pool.close()
+    _pools.clear()
+
+
+atexit.register(close_pools)
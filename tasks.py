@@ -6,12 +6,114 @@
 # a task to complete, such as reading from file, extracting concepts
 # and saving to disk again.
 
+import sys
+import threading
+import Queue
 from config import settings
 from utilities import time_log
-from data_loader import parse_medical_rec, parse_json, parse_edges, extract_semrep, extract_metamap, get_concepts_from_edges
+from checkpoint import Checkpoint
+from data_loader import parse_medical_rec, parse_json, parse_edges, stream_json, stream_edges, \
+                        extract_semrep, extract_metamap, extract_reverb, get_concepts_from_edges, \
+                        open_worker_pool, close_worker_pool
 from data_saver import save_csv, save_neo4j, save_json, save_json2, create_neo4j_results, \
-                        create_neo4j_csv, update_neo4j, update_mongo
-from tqdm import tqdm
+                        create_neo4j_csv, update_neo4j, update_mongo, close_csv_writers, \
+                        close_jsonl_writers
+
+
+# Keys of the pipeline trans phase that are options for the extractors
+# and not extractors themselves
+TRANS_OPTIONS = ['workers', 'dedupe_sentences']
+
+# Marks the end of the stream in the queues between phases
+END_OF_STREAM = None
+
+
+def put_batch(queue, batch, stop):
+    """
+    Put a batch in a bounded queue, waiting while it is full. Gives up if
+    stop is set by a failing phase.
+    Output:
+        - True if the batch was put in the queue
+    """
+    while not stop.is_set():
+        try:
+            queue.put(batch, timeout=1)
+            return True
+        except Queue.Full:
+            continue
+    return False
+
+
+def get_batch(queue, stop):
+    """
+    Get the next batch from a queue, waiting while it is empty. Returns
+    END_OF_STREAM if stop is set by a failing phase.
+    """
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=1)
+        except Queue.Empty:
+            continue
+    return END_OF_STREAM
+
+
+def stream_phase(func, inp, out, stop, errors):
+    """
+    Body of the thread of a pipeline phase in streaming mode. Batches are
+    taken from inp, passed through func and the results put in out, until
+    the end of the stream. The first phase has no inp and func is called
+    once with out, while the last phase has no out.
+    Input:
+        - func: function,
+        the work of the phase
+        - inp: Queue,
+        queue to read batches from
+        - out: Queue,
+        queue to put resulting batches in
+        - stop: threading.Event,
+        set when some phase fails, so that all the others stop
+        - errors: list,
+        the exc_info of failing phases is appended here
+    """
+    try:
+        if inp is None:
+            func(out, stop)
+        else:
+            while True:
+                batch = get_batch(inp, stop)
+                if batch is END_OF_STREAM:
+                    break
+                batch = func(batch)
+                if out is not None and not put_batch(out, batch, stop):
+                    break
+    except Exception:
+        errors.append(sys.exc_info())
+        stop.set()
+    finally:
+        if out is not None:
+            put_batch(out, END_OF_STREAM, stop)
+
+
+def get_outfield(parser_key):
+    """
+    Field of the json-style dictionaries holding the documents, or the
+    edges for the edges input.
+    """
+    if parser_key == 'edges':
+        return settings['load']['edges']['edge_field']
+    return settings['out']['json']['json_doc_field']
+
+
+def open_checkpoint():
+    """
+    Open the checkpoint given in the checkpoint section of settings.yaml,
+    or return None if checkpoints are disabled.
+    """
+    conf = settings.get('checkpoint') or {}
+    path = conf.get('path')
+    if not(path) or str(path) == 'None':
+        return None
+    return Checkpoint(path, conf.get('every', 1000))
 
 
 class Parser(object):
@@ -29,33 +131,54 @@ class Parser(object):
         """
 
         self.key = key
+        self.stream_func = None
         if self.key == 'med_rec':
             self.func = parse_medical_rec
         elif self.key == 'json':
             self.func = parse_json
+            self.stream_func = stream_json
         elif self.key == 'edges':
             self.func = parse_edges
+            self.stream_func = stream_edges
         if name:
             self.name = name
         else:
             self.name = self.key
 
-    def read(self):
+    def read(self, stream=False):
         """
         Run the corresponding parsing function and return the .json_
-        dictionary result.
+        dictionary result. If stream is True, an iterator over the
+        documents (or edges) is returned instead, reading the input
+        incrementally where the input type supports it.
         """
 
+        if stream:
+            return self.iter_docs()
         json_ = self.func()
         time_log('Completed Parsing. Read: %d documents!' % len(json_[settings['out']['json']['json_doc_field']]))
         return json_
 
+    def iter_docs(self):
+        """
+        Yield the parsed documents (or edges) one at a time. Input types
+        without a streaming parser are parsed in whole first.
+        """
+
+        if self.stream_func:
+            for doc in self.stream_func():
+                yield doc
+        else:
+            json_ = self.func()
+            for doc in json_[settings['out']['json']['json_doc_field']]:
+                yield doc
+
 
 class Extractor(object):
     """
     Class for extracting concepts/entities and relations from medical text.
     Expects to work with json files generated from the corresponding Parser
-    objects. Currently ['semrep'] implemented.
+    objects. Currently ['semrep', 'metamap', 'reverb'] implemented.
     Filepaths and details according to settings.yaml.
     """
 
@@ -73,29 +196,34 @@ class Extractor(object):
 
         self.key = key
         self.parser_key = parser_key
+        # Whether func spreads the work across the pool of worker processes
+        self.pooled = self.key in ['semrep', 'metamap', 'reverb']
         if self.key == 'semrep':
             self.func = extract_semrep
         elif self.key == 'metamap':
             self.func = extract_metamap
             # self.func = extract_metamap
         elif self.key == 'reverb':
-            raise NotImplementedError
+            self.func = extract_reverb
         elif self.key == 'get_concepts_from_edges':
             self.func = get_concepts_from_edges
-            # self.func = extract_reverb
         if name:
             self.name = name
         else:
             self.name = self.key
 
-    def run(self, json):
+    def run(self, json, pool=None):
         """
         Run the corresponding extracting function and return the .json_
-        dictionary result.
+        dictionary result. The pool of worker processes of the run, if any,
+        is passed on to the extractors that use it.
         """
 
         if type(json) == dict:
-            json_ = self.func(json, self.parser_key)
+            if self.pooled:
+                json_ = self.func(json, self.parser_key, pool)
+            else:
+                json_ = self.func(json, self.parser_key)
             time_log('Completed extracting using %s!' % self.name)
         else:
             time_log('Unsupported type of json to work on!')
@@ -125,13 +253,17 @@ class Dumper(object):
 
     def __init__(self, key, inp_key='json', name=None):
         self.key = key
+        # Finishes the output of a streaming dumper, check close
+        self.close_func = None
         if self.key == 'json':
             self.transform = None
             self.func = save_json
+            self.close_func = close_jsonl_writers
             #self.func = save_json2
         elif self.key == 'csv':
             self.transform = create_neo4j_results
             self.func = create_neo4j_csv
+            self.close_func = close_csv_writers
         elif self.key == 'neo4j':
             self.transform = create_neo4j_results
             self.func = update_neo4j
@@ -162,6 +294,16 @@ class Dumper(object):
             json_ = {}
         return json_
 
+    def close(self):
+        """
+        Finish the output of the dumper, e.g. write the aggregated csv
+        relations and import.sh, so that it is complete before the step is
+        checkpointed as done.
+        """
+
+        if self.close_func:
+            self.close_func()
+
 
 class taskCoordinator(object):
     """
@@ -177,80 +319,178 @@ class taskCoordinator(object):
                 if value:
                     self.pipeline[phase][key] = value
 
-    def run(self):
-        for phase in self.phases:
-            dic = self.pipeline[phase]
-            if phase == 'in':
-                # inp_types = [i.strip(' ').lower() for i in self.pipeline[phase]['inp'].split(',') if i]
-                parser = Parser(self.pipeline[phase]['inp'])
-                json_ = parser.read()
-            if phase == 'trans':
-                for key, value in dic.iteritems():
-                    if value:
-                        extractor = Extractor(key, parser.key)
-                        json_ = extractor.run(json_)
-            if phase == 'out':
-                for key, value in sorted(dic.iteritems()):
-                    if value:
-                        dumper = Dumper(key, parser.key)
-                        dumper.save(json_)
+    def steps(self):
+        """
+        List the steps of the pipeline in the order they run, as (phase, key)
+        tuples.
+        """
+
+        steps = [('in', self.pipeline['in']['inp'])]
+        steps.extend(('trans', key) for key, value in self.pipeline['trans'].iteritems()
+                     if value and not(key in TRANS_OPTIONS))
+        steps.extend(('out', key) for key, value in sorted(self.pipeline['out'].iteritems())
+                     if value)
+        return steps
+
+    def run(self, resume=False):
+        """
+        Run the pipeline. If path is set in the checkpoint section of
+        settings.yaml, the results are saved after every step and every few
+        documents within the extraction steps, so that with resume an
+        interrupted run continues from where it stopped. A single pool of
+        worker processes is used by all the extraction steps.
+        """
+        steps = self.steps()
+        parser = Parser(self.pipeline['in']['inp'])
+        outfield = get_outfield(parser.key)
+        checkpoint = open_checkpoint()
+        done = 0
+        position = 0
+        partial = []
+        json_ = None
+        if resume and checkpoint is not None:
+            state, position, partial = checkpoint.load()
+            if state is None:
+                time_log('No checkpoint found in %s. Starting from the beginning!' % checkpoint.path)
+            elif state['steps'] != steps:
+                time_log('The checkpoint in %s is for a different pipeline!' % checkpoint.path)
+                raise ValueError('Pipeline changed since the checkpoint was saved')
+            else:
+                done = state['done']
+                json_ = state['json_']
+                time_log('Resuming after step %d/%d with %d documents of the next step done'
+                         % (done, len(steps), position))
+        pool = open_worker_pool()
+        try:
+            for i in xrange(done, len(steps)):
+                phase, key = steps[i]
+                if phase == 'in':
+                    json_ = parser.read()
+                elif phase == 'trans':
+                    extractor = Extractor(key, parser.key)
+                    if checkpoint is None:
+                        json_ = extractor.run(json_, pool)
+                    else:
+                        json_ = self.run_chunks(extractor, json_, outfield, checkpoint, position,
+                                                partial, pool)
+                        position = 0
+                        partial = []
+                elif phase == 'out':
+                    dumper = Dumper(key, parser.key)
+                    dumper.save(json_)
+                    dumper.close()
+                if checkpoint is not None:
+                    checkpoint.save_state({'steps': steps, 'done': i + 1, 'json_': json_})
+        except Exception:
+            if checkpoint is not None:
+                time_log('Pipeline stopped! Continue from the last checkpoint with: python test.py --resume')
+            raise
+        finally:
+            close_worker_pool(pool)
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    def run_chunks(self, extractor, json_, outfield, checkpoint, position=0, partial=None, pool=None):
+        """
+        Run an extractor in chunks of checkpoint.every documents, saving
+        the results of every chunk in the checkpoint.
+        Input:
+            - extractor: Extractor,
+            the extractor to run
+            - json_: dic,
+            the results of the previous step
+            - outfield: str,
+            the field of json_ containing the documents (or edges)
+            - checkpoint: Checkpoint,
+            where to save the chunks
+            - position, partial: int, list,
+            number of documents already processed and their results, when
+            resuming
+            - pool: multiprocessing.Pool,
+            the pool of worker processes of the run, or None
+        Output:
+            - json_: dic,
+            json_ with the documents replaced by the extractor results
+        """
+        docs = json_[outfield]
+        results = list(partial or [])
+        for start in xrange(position, len(docs), checkpoint.every):
+            end = min(start + checkpoint.every, len(docs))
+            chunk = extractor.run({outfield: docs[start:end]}, pool)
+            results.extend(chunk[outfield])
+            checkpoint.add_chunk(end, chunk[outfield])
+            time_log('%s: %d/%d documents done' % (extractor.name, end, len(docs)))
+        json_[outfield] = results
+        return json_
 
     def run2(self):
-        stream_flag = self.pipeline['in']['stream'] == 'True'
+        """
+        Run the pipeline. If stream is True in the in phase, the documents
+        are read incrementally and pass through the trans and out phases in
+        micro-batches of batch_size documents. Each phase runs in its own
+        thread and the phases are connected with queues holding up to
+        queue_size batches, so that extraction, lookups and saving overlap.
+        The pool of worker processes is created once, before the threads
+        start, and used by every micro-batch. Otherwise, the same as run.
+        """
+        stream_flag = str(self.pipeline['in'].get('stream')) == 'True'
+        if not stream_flag:
+            return self.run()
         parser = Parser(self.pipeline['in']['inp'])
-        outfield = settings['out']['json']['json_doc_field']
-        json_all = parser.read()
-        if stream_flag:
-            for item in json_all[outfield]:
-                json_ = {outfield:[item]}
-                for phase in self.phases:
-                    dic = self.pipeline[phase]
-                    if phase == 'trans':
-                        for key, value in dic.iteritems():
-                            if value:
-                                extractor = Extractor(key, parser.key)
-                                json_ = extractor.run(json_)
-                    if phase == 'out':
-                        for key, value in sorted(dic.iteritems()):
-                            if value:
-                                dumper = Dumper(key, parser.key)
-                                dumper.save(json_)
+        outfield = get_outfield(parser.key)
+        batch_size = self.pipeline['in'].get('batch_size', 100)
+        queue_size = self.pipeline['in'].get('queue_size', 4)
+        # Extractors and dumpers are created once for the whole stream
+        extractors = [Extractor(key, parser.key) for key, value in self.pipeline['trans'].iteritems()
+                      if value and not(key in TRANS_OPTIONS)]
+        dumpers = [Dumper(key, parser.key) for key, value in sorted(self.pipeline['out'].iteritems())
+                   if value]
 
-        else:
-            json_ = json_all
-            for phase in self.phases:
-                dic = self.pipeline[phase]
-                if phase == 'trans':
-                    for key, value in dic.iteritems():
-                        if value:
-                            extractor = Extractor(key, parser.key)
-                            json_ = extractor.run(json_)
-                if phase == 'out':
-                    for key, value in sorted(dic.iteritems()):
-                        if value:
-                            dumper = Dumper(key, parser.key)
-                            dumper.save(json_)
-
-
-        # parser = Parser(self.pipeline['in']['inp'])
-        # out_outfield = settings['out']['json']['json_doc_field']
-        # json_ = parser.read()
-        # for doc in tqdm(json_[out_outfield]):
-        #     tmp = {out_outfield:[doc]}
-        #     for phase in self.phases:
-        #         dic = self.pipeline[phase]
-        #         if phase == 'in':
-        #             pass
-        #         if phase == 'trans':
-        #             for key, value in dic.iteritems():
-        #                 if value:
-        #                     extractor = Extractor(key, parser.key)
-        #                     tmp = extractor.run(tmp)
-        #         if phase == 'out':
-        #             for key, value in sorted(dic.iteritems()):
-        #                 if value:
-        #                     dumper = Dumper(key, parser.key)
-        #                     dumper.save(tmp)
+        def read(out, stop):
+            batch = []
+            c = 0
+            for doc in parser.read(stream=True):
+                batch.append(doc)
+                if len(batch) == batch_size:
+                    c += len(batch)
+                    if not put_batch(out, {outfield: batch}, stop):
+                        return
+                    time_log('Read %d documents so far' % c)
+                    batch = []
+            if batch:
+                put_batch(out, {outfield: batch}, stop)
+
+        def transform(json_):
+            for extractor in extractors:
+                json_ = extractor.run(json_, pool)
+            return json_
+
+        def save(json_):
+            for dumper in dumpers:
+                dumper.save(json_)
+
+        pool = open_worker_pool()
+        to_trans = Queue.Queue(queue_size)
+        to_out = Queue.Queue(queue_size)
+        stop = threading.Event()
+        errors = []
+        threads = [threading.Thread(target=stream_phase, args=(read, None, to_trans, stop, errors)),
+                   threading.Thread(target=stream_phase, args=(transform, to_trans, to_out, stop, errors)),
+                   threading.Thread(target=stream_phase, args=(save, to_out, None, stop, errors))]
+        try:
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        finally:
+            close_worker_pool(pool)
+            for dumper in dumpers:
+                dumper.close()
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
 
     def print_pipeline(self):
         print('#'*30 + ' Pipeline Schedule' + '#'*30)
@@ -261,7 +501,8 @@ class taskCoordinator(object):
             if phase == 'trans':
                 print('Will use the following transformation utilities:')
                 for key, value in dic.iteritems():
-                    print ('- %s' % key)
+                    if not(key in TRANS_OPTIONS):
+                        print ('- %s' % key)
             if phase == 'out':
                 print('Will save the outcome as follows:')
                 for key, value in dic.iteritems():
@@ -5,6 +5,7 @@
 # Simple script to run the Pipeline Wrapper,
 
 
+import sys
 import logging
 from tasks import taskCoordinator
 from config import settings
@@ -15,6 +16,7 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(message)s')
 
 TaskManager = taskCoordinator()
 TaskManager.print_pipeline()
-TaskManager.run()
+# Continue an interrupted run from its checkpoint with: python test.py --resume
+TaskManager.run(resume='--resume' in sys.argv)
 #TaskManager.run2()
 exit(1)
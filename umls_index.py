@@ -0,0 +1,217 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Local replacement of the UMLS REST services used when fetching concepts.
+# A compact SQLite index is built once from the RRF files of a licensed
+# UMLS release and then queried through a memory-mapped connection.
+
+import os
+import sys
+import sqlite3
+from utilities import time_log, get_sem_type_table
+
+
+def iter_rrf_groups(path):
+    """
+    Yield the rows of an RRF file grouped by their first field, which is
+    the CUI in MRCONSO.RRF and MRSTY.RRF. The files are sorted by CUI as
+    distributed, so the rows of a CUI are consecutive.
+    Input:
+        - path: str,
+        path to the RRF file
+    Output:
+        - generator of (cui, rows) tuples, each row being the list of
+        |-delimited fields
+    """
+    cur_cui = None
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            elements = line.rstrip('\n').split('|')
+            if elements[0] != cur_cui:
+                if rows:
+                    yield cur_cui, rows
+                cur_cui = elements[0]
+                rows = []
+            rows.append(elements)
+    if rows:
+        yield cur_cui, rows
+
+
+def preferred_name(rows):
+    """
+    Pick the preferred name of a concept among its MRCONSO rows, the same
+    name the REST services return. Rows are in the MRCONSO order
+    CUI|LAT|TS|LUI|STT|SUI|ISPREF|AUI|SAUI|SCUI|SDUI|SAB|TTY|CODE|STR|...
+    """
+    english = [row for row in rows if row[1] == 'ENG']
+    for row in english:
+        if row[2] == 'P' and row[4] == 'PF' and row[6] == 'Y':
+            return row[14]
+    if english:
+        return english[0][14]
+    return rows[0][14]
+
+
+def build_umls_index(meta_dir, index_path, sabs=None, batch_size=10000):
+    """
+    Build the local concept index from the MRCONSO.RRF and MRSTY.RRF files
+    of a UMLS release. The abbreviations of the semantic types are taken
+    from the sem-type table of utilities (bundled sem_types.tsv, updated
+    with the SRDEF file given in the settings).
+    Input:
+        - meta_dir: str,
+        directory containing the RRF files (e.g. 2015AA/META)
+        - index_path: str,
+        path to the SQLite index to create
+        - sabs: list,
+        source vocabularies to index the codes of (e.g. ['MSH', 'DRUGBANK']).
+        None for all of them
+        - batch_size: int,
+        number of rows inserted at once
+    Output: None, creates the index file
+    """
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    conn = sqlite3.connect(index_path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('CREATE TABLE concepts (cui TEXT PRIMARY KEY, label TEXT, sem_types TEXT)')
+    conn.execute('CREATE TABLE sources (sab TEXT, code TEXT, cui TEXT, PRIMARY KEY (sab, code, cui))')
+    concepts = []
+    sources = []
+    c = 0
+    for cui, rows in iter_rrf_groups(os.path.join(meta_dir, 'MRCONSO.RRF')):
+        concepts.append((cui, preferred_name(rows), ''))
+        for row in rows:
+            if sabs is None or row[11] in sabs:
+                # Codes can be searched by CODE, SCUI or SDUI as sourceUi
+                for code in set([row[13], row[9], row[10]]):
+                    if code:
+                        sources.append((row[11], code, cui))
+        if len(concepts) >= batch_size:
+            conn.executemany('INSERT INTO concepts VALUES (?, ?, ?)', concepts)
+            conn.executemany('INSERT OR IGNORE INTO sources VALUES (?, ?, ?)', sources)
+            c += len(concepts)
+            concepts = []
+            sources = []
+            if c % (100*batch_size) == 0:
+                time_log('Indexed %d concepts' % c)
+    conn.executemany('INSERT INTO concepts VALUES (?, ?, ?)', concepts)
+    conn.executemany('INSERT OR IGNORE INTO sources VALUES (?, ?, ?)', sources)
+    c += len(concepts)
+    conn.commit()
+    time_log('Indexed %d concepts from MRCONSO' % c)
+    table = get_sem_type_table()
+    updates = []
+    for cui, rows in iter_rrf_groups(os.path.join(meta_dir, 'MRSTY.RRF')):
+        # MRSTY fields: CUI|TUI|STN|STY|ATUI|CVF
+        updates.append((','.join([table.get(row[1], row[1]) for row in rows]), cui))
+        if len(updates) >= batch_size:
+            conn.executemany('UPDATE concepts SET sem_types = ? WHERE cui = ?', updates)
+            updates = []
+    conn.executemany('UPDATE concepts SET sem_types = ? WHERE cui = ?', updates)
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+    time_log('Created UMLS index in %s' % index_path)
+
+
+class UmlsIndex(object):
+    """
+    Lookups in the local concept index, offering the same methods as the
+    UmlsClient of utilities, so that it can replace it. The index is opened
+    read-only and memory-mapped, so lookups don't go through file reads.
+    """
+
+    def __init__(self, index_path, mmap_size=1 << 33):
+        """
+        Initialization of the class.
+        Input:
+            - index_path: str,
+            path to the index created with build_umls_index
+            - mmap_size: int,
+            maximum number of bytes of the index to memory-map
+        """
+
+        if not os.path.isfile(index_path):
+            raise IOError('No UMLS index found in %s. Build it with build_umls_index!' % index_path)
+        self.index_path = index_path
+        self.mmap_size = mmap_size
+        self.conn = None
+        self.pid = None
+
+    def connect(self):
+        """
+        Open the connection of the current process.
+        """
+
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.index_path, check_same_thread=False)
+            self.conn.execute('PRAGMA query_only=1')
+            self.conn.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+            self.pid = os.getpid()
+        return self.conn
+
+    def concept_from_cui(self, cui):
+        """
+        Fetch a concept's attributes from the corresponding cui, in the
+        same form as get_concept_from_cui. Raises ValueError if missing.
+        """
+
+        row = self.connect().execute('SELECT label, sem_types FROM concepts WHERE cui = ?',
+                                     (cui,)).fetchone()
+        if row is None:
+            time_log('Error getting concept from cui : %s' % cui)
+            raise ValueError
+        return {'label': row[0], 'cuid': cui, 'sem_types': row[1]}
+
+    def concepts_from_source(self, source_id, source):
+        """
+        Map an entity from another source to UMLS concepts, in the same
+        form as get_concept_from_source.
+        """
+
+        rows = self.connect().execute('SELECT cui FROM sources WHERE sab = ? AND code = ?',
+                                      (source, source_id)).fetchall()
+        return [self.concept_from_cui(row[0]) for row in rows]
+
+    def sem_type_abbr(self, code_tui):
+        """
+        Fetch a semantic-type's abbreviation from the sem-type table of
+        utilities, in the same form as get_sem_type_abbr. The index works
+        offline, so codes missing from the table raise ValueError instead
+        of going to the REST services.
+        """
+
+        table = get_sem_type_table()
+        if not(code_tui in table):
+            time_log('Error getting sem-type from TUI : %s' % code_tui)
+            raise ValueError
+        return table[code_tui]
+
+    def resolve_many(self, cuis):
+        """
+        Fetch the concepts of many cuis at once. Check UmlsClient.resolve_many
+        for details.
+        """
+
+        cuis = list(set(cuis))
+        found = dict((cui, None) for cui in cuis)
+        conn = self.connect()
+        for i in xrange(0, len(cuis), 500):
+            batch = cuis[i:i+500]
+            quer = 'SELECT cui, label, sem_types FROM concepts WHERE cui IN (%s)' % ','.join(['?']*len(batch))
+            for cui, label, sem_types in conn.execute(quer, batch):
+                found[cui] = {'label': label, 'cuid': cui, 'sem_types': sem_types}
+        return found
+
+
+if __name__ == '__main__':
+    # Usage: python umls_index.py <META dir> <index path> [SAB,SAB,...]
+    if len(sys.argv) < 3:
+        print 'Usage: python umls_index.py <META dir> <index path> [SAB,SAB,...]'
+        exit(1)
+    sabs = sys.argv[3].split(',') if len(sys.argv) > 3 else None
+    build_umls_index(sys.argv[1], sys.argv[2], sabs)
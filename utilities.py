@@ -6,32 +6,48 @@ Utility functions.
 """
 
 
+import os
 import time
 import logging
 import requests
 import json
+from multiprocessing.pool import ThreadPool
 from config import settings
-from Authentication import Authentication
+from Authentication import Authentication, TicketManager
 
 
-# API-kEY FOR UMLS REST TICKET SERVICES
-umls_api = settings['apis']['umls']
-# UMLS REST SERVICES INITIALIZATION OF CLIENT AND TICKET
-# GRANTING SERVICE TO BE USED IN ALL CASES
-AuthClient = Authentication(umls_api)
-tgt = AuthClient.gettgt()
+# UMLS REST SERVICES TICKET MANAGER, RENEWING THE TGT AND PREFETCHING
+# SERVICE TICKETS TO BE USED IN ALL CASES. CREATED ON FIRST USE
+_ticket_manager = None
 
 
+# Bundled table of TUI codes to abbreviations of the semantic types
+SEM_TYPES_PATH = os.path.join(os.path.dirname(__file__), 'sem_types.tsv')
+_sem_type_table = None
+
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
-def get_umls_ticket(apikey=None, AuthClient=AuthClient, tgt=tgt):
+def get_ticket_manager():
+    """
+    Get the ticket manager of the module, created on the first call with
+    the API-kEY FOR UMLS REST TICKET SERVICES found in the settings.
+    """
+    global _ticket_manager
+    if _ticket_manager is None:
+        _ticket_manager = TicketManager(settings['apis']['umls'],
+                                        settings['umls']['ticket_pool_size'],
+                                        settings['umls']['tgt_lifetime'])
+    return _ticket_manager
+
+
+def get_umls_ticket(apikey=None):
     """
     Get a single use ticket for the UMLS REST services.
-    It is supposed that an Author Client and a Ticket
-    Granting Service have already been set-up in case
-    the apikey = None. If an api-key is given, create the
-    above needed instances and generate a new ticket.
+    In case the apikey = None, the ticket is taken from the
+    tickets prefetched by the ticket manager of the module.
+    If an api-key is given, create a new client and Ticket
+    Granting Ticket and generate a new ticket.
     Input:
         - apikey: str,
         UMLS REST services api-key. Default is None and
@@ -42,7 +58,7 @@ def get_umls_ticket(apikey=None, AuthClient=AuthClient, tgt=tgt):
 
     # Get ticket from the already establised service
     if apikey is None:
-        return AuthClient.getst(tgt)
+        return get_ticket_manager().get_ticket()
     else:
         # Establish new Client and Ticket granting service
         AuthClient = Authentication(apikey)
@@ -84,25 +100,9 @@ def get_concept_from_source(source_id, source, apikey=None):
         Check get_concept_from_cui for more details
     """
 
-    ticket = get_umls_ticket(apikey)
-    params = {'string': source_id, 'sabs': source, 'searchType': 'exact',
-              'inputType': 'sourceUi', 'ticket': ticket}
-    url = "https://uts-ws.nlm.nih.gov/rest/search/current"
-    r = requests.get(url, params=params)
-    r.encoding = 'utf-8'
-    concepts = []
-    if r.ok:
-        items = json.loads(r.text)
-        jsonData = items["result"]
-        # Get cuis related to source_id
-        cuis = [res['ui']for res in jsonData['results']]
-        # Get concepts from cuis
-        concepts = [get_concept_from_cui(cui, apikey) for cui in cuis]
-    else:
-        time_log(r.url)
-        time_log('Error getting concept from: Source %s   | ID: %s' % (source, source_id))
-        raise ValueError
-    return concepts
+    if apikey is None:
+        return get_umls_client().concepts_from_source(source_id, source)
+    return UmlsClient(apikey, workers=1).concepts_from_source(source_id, source)
 
 
 def get_concept_from_cui(cui, apikey=None):
@@ -122,31 +122,9 @@ def get_concept_from_cui(cui, apikey=None):
         the semantic types us returned)
     """
 
-    ticket = get_umls_ticket(apikey)
-    url = "https://uts-ws.nlm.nih.gov/rest/content/current/CUI/" + cui
-    r = requests.get(url, params={'ticket': ticket})
-    r.encoding = 'utf-8'
-    res = {}
-    if r.ok:
-        items = json.loads(r.text)
-        jsonData = items["result"]
-        res = {'label': jsonData['name'], 'cuid': cui}
-        sem_types = []
-        # For each semantic type of the entity
-        for stys in jsonData["semanticTypes"]:
-            # Keep only the TUI code from the uri e.g.
-            # https://uts-ws.nlm.nih.gov/rest/semantic-network/current/TUI/T116
-            code_tui = stys['uri'].split('/')[-1]
-            # Fetch the abbreviation of this TUI code
-            sem_types.append(get_sem_type_abbr(code_tui, apikey))
-        # Comma separated string
-        sem_types = ",".join(sem_types)
-        res['sem_types'] = sem_types
-    else:
-        time_log(r.url)
-        time_log('Error getting concept from cui : %s' % cui)
-        raise ValueError
-    return res
+    if apikey is None:
+        return get_umls_client().concept_from_cui(cui)
+    return UmlsClient(apikey, workers=1).concept_from_cui(cui)
 
 
 def get_sem_type_abbr(code_tui, apikey=None):
@@ -163,17 +141,236 @@ def get_sem_type_abbr(code_tui, apikey=None):
         string, abbreviation of the code (e.g. "gngm")
     """
 
-    ticket = get_umls_ticket(apikey)
-    url = "https://uts-ws.nlm.nih.gov/rest/semantic-network/current/TUI/" + code_tui
-    r = requests.get(url, params={'ticket': ticket})
-    r.encoding = 'utf-8'
-    res = ' '
-    if r.ok:
-        items = json.loads(r.text)
-        jsonData = items["result"]
-        res = jsonData['abbreviation']
-    else:
-        time_log(r.url)
-        time_log('Error getting sem-type from TUI : %s' % code_tui)
-        raise ValueError
-    return res
\ No newline at end of file
+    if apikey is None:
+        return get_umls_client().sem_type_abbr(code_tui)
+    return UmlsClient(apikey, workers=1).sem_type_abbr(code_tui)
+
+
+def read_srdef(srdef_path):
+    """
+    Read the TUI code to abbreviation mapping of the semantic types from
+    the SRDEF file of the UMLS semantic network.
+    Input:
+        - srdef_path: str,
+        path to the SRDEF file
+    Output:
+        - table: dic,
+        dictionary of TUI code to abbreviation (e.g. T116 -> aapp)
+    """
+    table = {}
+    with open(srdef_path, 'r') as f:
+        for line in f:
+            elements = line.rstrip('\n').split('|')
+            # Fields: RT|UI|STY/RL|STN/RTN|DEF|EX|UN|NH|ABR|RIN
+            if elements[0] == 'STY' and len(elements) > 8:
+                table[elements[1]] = elements[8]
+    return table
+
+
+def get_sem_type_table():
+    """
+    Get the table of TUI codes to semantic-type abbreviations. Loaded once
+    per process from the bundled sem_types.tsv, updated with the SRDEF
+    file given in the umls settings if any. Abbreviations fetched from the
+    REST services for codes missing from it are added to it.
+    Output:
+        - table: dic,
+        dictionary of TUI code to abbreviation
+    """
+    global _sem_type_table
+    if _sem_type_table is None:
+        table = {}
+        with open(SEM_TYPES_PATH, 'r') as f:
+            for line in f:
+                elements = line.rstrip('\n').split('\t')
+                if len(elements) > 1:
+                    table[elements[0]] = elements[1]
+        srdef_path = settings['umls']['srdef_path']
+        if srdef_path and srdef_path != 'None':
+            table.update(read_srdef(srdef_path))
+        _sem_type_table = table
+    return _sem_type_table
+
+
+class UmlsClient(object):
+    """
+    Client for the UMLS REST services. All the requests go through a
+    single requests.Session, so connections are pooled and kept alive,
+    and many concepts can be resolved concurrently with resolve_many.
+    """
+
+    base_url = "https://uts-ws.nlm.nih.gov/rest"
+
+    def __init__(self, apikey=None, workers=8):
+        """
+        Initialization of the class.
+        Input:
+            - apikey: str,
+            UMLS REST services api-key. Default is None and
+            the already establised service is used. Check get_umls_ticket
+            function for details
+            - workers: int,
+            number of concurrent requests made by resolve_many
+        """
+
+        self.apikey = apikey
+        self.workers = max(int(workers), 1)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.workers,
+                                                max_retries=3)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, params=None):
+        """
+        Make a GET request to the UMLS REST services with a new ticket.
+        Input:
+            - path: str,
+            path of the service after the base url
+            - params: dic,
+            parameters of the request, other than the ticket
+        Output:
+            - r: requests.Response,
+            the response of the service
+        """
+
+        params = dict(params or {})
+        params['ticket'] = get_umls_ticket(self.apikey)
+        r = self.session.get(self.base_url + path, params=params)
+        r.encoding = 'utf-8'
+        return r
+
+    def concept_from_cui(self, cui):
+        """
+        Fetch a concept's attributes from the corresponding cui. Check
+        get_concept_from_cui for details.
+        """
+
+        r = self.get("/content/current/CUI/" + cui)
+        res = {}
+        if r.ok:
+            items = json.loads(r.text)
+            jsonData = items["result"]
+            res = {'label': jsonData['name'], 'cuid': cui}
+            sem_types = []
+            # For each semantic type of the entity
+            for stys in jsonData["semanticTypes"]:
+                # Keep only the TUI code from the uri e.g.
+                # https://uts-ws.nlm.nih.gov/rest/semantic-network/current/TUI/T116
+                code_tui = stys['uri'].split('/')[-1]
+                # Fetch the abbreviation of this TUI code
+                sem_types.append(self.sem_type_abbr(code_tui))
+            # Comma separated string
+            sem_types = ",".join(sem_types)
+            res['sem_types'] = sem_types
+        else:
+            time_log(r.url)
+            time_log('Error getting concept from cui : %s' % cui)
+            raise ValueError
+        return res
+
+    def concepts_from_source(self, source_id, source):
+        """
+        Map an entity from another source to UMLS concepts. Check
+        get_concept_from_source for details.
+        """
+
+        params = {'string': source_id, 'sabs': source, 'searchType': 'exact',
+                  'inputType': 'sourceUi'}
+        r = self.get("/search/current", params)
+        concepts = []
+        if r.ok:
+            items = json.loads(r.text)
+            jsonData = items["result"]
+            # Get cuis related to source_id
+            cuis = [res['ui']for res in jsonData['results']]
+            # Get concepts from cuis
+            concepts = [self.concept_from_cui(cui) for cui in cuis]
+        else:
+            time_log(r.url)
+            time_log('Error getting concept from: Source %s   | ID: %s' % (source, source_id))
+            raise ValueError
+        return concepts
+
+    def sem_type_abbr(self, code_tui):
+        """
+        Fetch a semantic-type's abbreviation. Check get_sem_type_abbr
+        for details.
+        """
+
+        table = get_sem_type_table()
+        if code_tui in table:
+            return table[code_tui]
+        r = self.get("/semantic-network/current/TUI/" + code_tui)
+        res = ' '
+        if r.ok:
+            items = json.loads(r.text)
+            jsonData = items["result"]
+            res = jsonData['abbreviation']
+            # Remember it for the next concepts of this type
+            table[code_tui] = res
+        else:
+            time_log(r.url)
+            time_log('Error getting sem-type from TUI : %s' % code_tui)
+            raise ValueError
+        return res
+
+    def try_concept_from_cui(self, cui):
+        """
+        Same as concept_from_cui, but returns None on errors, so that a
+        single failing cui doesn't stop a bulk resolution.
+        """
+
+        try:
+            return self.concept_from_cui(cui)
+        except Exception, e:
+            time_log('Could not resolve cui %s: %s' % (cui, e))
+            return None
+
+    def resolve_many(self, cuis):
+        """
+        Fetch the concepts of many cuis concurrently. Duplicate cuis are
+        requested only once.
+        Input:
+            - cuis: iterable,
+            the cuis to look up
+        Output:
+            - concepts: dic,
+            dictionary of cui to the concept found, as returned by
+            get_concept_from_cui, or None if it couldn't be fetched
+        """
+
+        cuis = list(set(cuis))
+        if not cuis:
+            return {}
+        if len(cuis) == 1 or self.workers == 1:
+            return dict((cui, self.try_concept_from_cui(cui)) for cui in cuis)
+        pool = ThreadPool(min(self.workers, len(cuis)))
+        try:
+            concepts = pool.map(self.try_concept_from_cui, cuis)
+        finally:
+            pool.close()
+            pool.join()
+        time_log('Resolved %d cuis' % len(cuis))
+        return dict(zip(cuis, concepts))
+
+
+_umls_client = None
+
+
+def get_umls_client():
+    """
+    Get the UMLS client of the process, shared by all the lookups that
+    use the already establised service. Created on the first call
+    according to the umls settings: a UmlsClient for the REST services
+    if backend is rest, or the UmlsIndex of umls_index, answering from
+    the local index, if backend is local.
+    """
+    global _umls_client
+    if _umls_client is None:
+        if settings['umls']['backend'] == 'local':
+            from umls_index import UmlsIndex
+            _umls_client = UmlsIndex(settings['umls']['index_path'])
+        else:
+            _umls_client = UmlsClient(workers=settings['umls']['workers'])
+    return _umls_client